@@ -2,55 +2,272 @@
 # -*- coding: utf-8 -*-
 
 from sh import adb
-from time import sleep
+import time
+import os
 import re
+import signal
+import socket
+import subprocess
+import threading
+from contextlib import contextmanager
+import adb_client
+import metrics
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+error_statuses = ['offline', 'no permissions']
+server_address = ('127.0.0.1', int(os.environ.get('ANDROID_ADB_SERVER_PORT', 5037)))
+max_commands_per_device = int(os.environ.get('ADB_MAX_COMMANDS_PER_DEVICE', 4))
+
+_slots = {}  # serial -> semaphore bounding concurrent adb commands on that device
+_slots_lock = threading.Lock()
+
+command_latency = metrics.histogram('adb_command_duration_seconds', 'adb commands, by device and subcommand.', ['serial', 'command'], split='adb')
+
+
+class DeviceTracker(threading.Thread):
+    '''keep the adb server's `host:track-devices` stream open and mirror its serial -> state map.'''
+
+    def __init__(self, address=server_address):
+        threading.Thread.__init__(self, name='adb-device-tracker')
+        self.daemon = True
+        self.address = address
+        self.synced = threading.Event()
+        self._devices = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+
+    def start_once(self):
+        with self._start_lock:
+            if not self.is_alive():
+                self.start()
+
+    def devices(self):
+        with self._lock:
+            return dict(self._devices)
+
+    def subscribe(self, listener):
+        '''listener(event) is called from the tracker thread with {"serial", "status", "previous"} on every change.
+        "status" is None when the device got detached, "previous" is None when it just got attached.'''
+        with self._lock:
+            self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def run(self):
+        while True:
+            try:
+                self._track()
+            except (socket.error, EOFError, ValueError, adb_client.AdbError):
+                pass
+            self.synced.clear()
+            try:
+                adb('start-server')
+            except:
+                pass
+            time.sleep(1)
+
+    def _track(self):
+        sock = socket.create_connection(self.address)
+        try:
+            sock.sendall(adb_client.request('host:track-devices'))
+            adb_client.check_okay(sock)
+            while True:
+                self._update(_parse_devices(adb_client.read_message(sock)))
+                self.synced.set()
+        finally:
+            sock.close()
+
+    def _update(self, current):
+        with self._lock:
+            previous, self._devices = self._devices, current
+            listeners = list(self._listeners)
+        events = [{'serial': se, 'status': current.get(se), 'previous': previous.get(se)}
+                  for se in set(previous) | set(current) if previous.get(se) != current.get(se)]
+        for event in events:
+            for listener in listeners:
+                try:
+                    listener(event)
+                except:
+                    pass
+
+
+class SlotTimeout(adb_client.AdbError):
+    '''the device had no free command slot before the command timed out.'''
+
+
+tracker = DeviceTracker()
+client = adb_client.AdbClient(server_address)
 
 
 def devices(status='all'):
+    tracker.start_once()
+    if tracker.synced.is_set():
+        return filter_status(tracker.devices(), status)
     out = adb.devices().stdout.decode('utf-8')
     match = "List of devices attached"
     index = out.find(match)
-    error_statuses = ['offline', 'no permissions']
     if index < 0:
         return {}
     else:
-        all = dict([s.split('\t') for s in out[index + len(match):].strip().splitlines() if s.strip()])
-        if status in error_statuses:
-            return dict(filter(lambda pair: pair[1] == status, all.items()))
-        elif status in ['error', 'err', 'bad']:
-            return dict(filter(lambda pair: pair[1] in error_statuses, all.items()))
-        elif status in ['ok', 'ready', 'good', 'alive']:
-            return dict(filter(lambda pair: pair[1] not in error_statuses, all.items()))
-        elif status == 'all':
-            return all
-        else:
-            return {}
+        return filter_status(_parse_devices(out[index + len(match):]), status)
 
 
-def cmd(cmds, **kwargs):
-    proc = adb(*cmds, _bg=True)
-    start, interval, timeout = 0, 0.1, int(kwargs.get('timeout', 10))
-    while start < timeout:
-        sleep(interval)
-        start += interval
-        if not proc.process.alive:
-            break
+def _parse_devices(text):
+    return dict([s.split('\t') for s in text.strip().splitlines() if s.strip()])
+
+
+def filter_status(all, status):
+    if status in error_statuses:
+        return dict(filter(lambda pair: pair[1] == status, all.items()))
+    elif status in ['error', 'err', 'bad']:
+        return dict(filter(lambda pair: pair[1] in error_statuses, all.items()))
+    elif status in ['ok', 'ready', 'good', 'alive']:
+        return dict(filter(lambda pair: pair[1] not in error_statuses, all.items()))
+    elif status == 'all':
+        return all
     else:
-        proc.kill()
+        return {}
+
+
+@contextmanager
+def device_slot(serial, timeout=None):
+    '''limit the number of adb commands running at the same time against one device.
+
+    Waits at most timeout seconds for a slot, raising SlotTimeout, and yields the time left.'''
+    with _slots_lock:
+        if serial not in _slots:
+            _slots[serial] = threading.BoundedSemaphore(max_commands_per_device)
+        slot = _slots[serial]
+    started = time.time()
+    if not _acquire(slot, timeout):
+        raise SlotTimeout('no free adb slot on %s within %ss' % (serial, timeout))
     try:
-        proc.wait()
-    except:
-        pass
+        yield None if timeout is None else max(timeout - (time.time() - started), 0.01)
+    finally:
+        slot.release()
+
+
+def _acquire(semaphore, timeout):
+    if timeout is None:
+        return semaphore.acquire()
+    try:
+        return semaphore.acquire(timeout=timeout)
+    except TypeError:  # python 2 semaphores take no timeout
+        deadline = time.time() + timeout
+        while not semaphore.acquire(False):
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+
+def cmd(cmds, **kwargs):
+    '''run `adb cmds`; shell and exec-out commands on a device go through the adb server socket, without forking adb.
+
+    A command timing out, waiting for a slot of the device included, returns -SIGKILL as if adb got killed.'''
+    cmds = list(cmds)
+    serial = cmds[cmds.index('-s') + 1] if '-s' in cmds[:-1] else None
+    args = [c for i, c in enumerate(cmds) if c != '-s' and (i == 0 or cmds[i - 1] != '-s')]
+    timeout = float(kwargs.get('timeout', 10))
+    with metrics.timer(command_latency, (serial or '', args[0] if args else '')):
+        try:
+            if serial and len(args) > 1 and args[0] in ('shell', 'exec-out'):
+                try:
+                    with device_slot(serial, timeout) as remaining:
+                        if args[0] == 'shell':
+                            return client.shell(serial, ' '.join(args[1:]), timeout=remaining)
+                        return {'stdout': client.exec_out(serial, ' '.join(args[1:]), timeout=remaining), 'stderr': b'', 'returncode': 0}
+                except SlotTimeout:
+                    raise
+                except adb_client.AdbError as e:
+                    return {'stdout': b'', 'stderr': ('error: %s\n' % e).encode('utf-8'), 'returncode': 1}
+                except (socket.error, EOFError):
+                    pass  # no adb server to talk to (yet), the adb binary starts one
+            return _cmd(cmds, serial, timeout=timeout)
+        except SlotTimeout:
+            return {'stdout': b'', 'stderr': b'', 'returncode': -signal.SIGKILL}
+
+
+def _cmd(cmds, serial, **kwargs):
+    with device_slot(serial, float(kwargs.get('timeout', 10))) as remaining:
+        proc = subprocess.Popen(['adb'] + cmds, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        killer = threading.Timer(remaining, _kill, [proc])
+        killer.daemon = True
+        killer.start()
+        try:
+            stdout, stderr = proc.communicate()  # returns as soon as adb exits, or once the killer fires.
+        finally:
+            killer.cancel()
     return {
-        'stdout': proc.stdout,
-        'stderr': proc.stderr,
-        'returncode': proc.exit_code
+        'stdout': stdout,
+        'stderr': stderr,
+        'returncode': proc.returncode
     }
 
 
+def _kill(proc):
+    try:
+        proc.kill()
+    except OSError:
+        pass
+
+
+def shell(serial, *args, **kwargs):
+    '''run `adb -s serial shell args` in process through the adb server, falling back to the adb binary.'''
+    return cmd(['-s', serial, 'shell'] + list(args), **kwargs)
+
+
+def exec_out(serial, *args, **kwargs):
+    '''binary-safe output of `adb -s serial exec-out args`; raises SlotTimeout, an AdbError, when the device stays busy.'''
+    with metrics.timer(command_latency, (serial, 'exec-out')):
+        try:
+            with device_slot(serial, float(kwargs.get('timeout', 10))) as remaining:
+                return client.exec_out(serial, ' '.join(args), timeout=remaining)
+        except (socket.error, EOFError):
+            return _cmd(['-s', serial, 'exec-out'] + list(args), serial, **kwargs)['stdout']
+
+
 def getprop(serial, prop=None):
     if prop:
-        return cmd(['-s', serial, 'shell', 'getprop', prop])['stdout'].strip()
+        return shell(serial, 'getprop', prop)['stdout'].strip()
     else:
-        out = cmd(['-s', serial, 'shell', 'getprop'])['stdout']
+        out = shell(serial, 'getprop')['stdout']
         return dict(re.findall(r"\[([^[\]]+)\]: +\[([^[\]]+)\]", out.decode('utf-8')))
+
+
+def parallel(fn, items, size=8):
+    '''call fn on every item using at most `size` threads, yield (item, result, error) as each one completes.
+
+    The threads are not the request's, so the time the caller waits for them is its adb time.'''
+    items = list(items)
+    pending, done = queue.Queue(), queue.Queue()
+    for item in items:
+        pending.put(item)
+
+    def worker():
+        while True:
+            try:
+                item = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                done.put((item, fn(item), None))
+            except Exception as e:
+                done.put((item, None, e))
+
+    for i in range(min(max(int(size), 1), len(items))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+    for i in range(len(items)):
+        started = time.time()
+        result = done.get()
+        metrics.account('adb', time.time() - started)
+        yield result
@@ -1,27 +1,60 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from bottle import Bottle, run
+from bottle import Bottle, run, request, response, abort
+import metrics
+import profiling
 
 app = Bottle()
+app.install(metrics.Plugin())
 
 
 @app.get("/api/ping")
 def ping():
     return "pong"
 
+
+@app.get("/api/metrics")
+def expose_metrics():
+    response.content_type = 'text/plain; version=0.0.4'
+    return metrics.expose()
+
+
+@app.get("/api/admin/profile")
+def run_profiler():
+    '''sample all thread stacks for ?seconds=N (at most 60), returned folded for flamegraph.pl.'''
+    seconds = min(max(float(request.params.get('seconds', 10)), 0.1), 60)
+    folded = profiling.profile(seconds)
+    if folded is None:
+        abort(409, 'A profile is running already!')
+    response.content_type = 'text/plain'
+    return folded
+
 from jobs import app as job_app
+job_app.install(metrics.Plugin('/api/0/jobs'))
 app.mount("/api/0/jobs", job_app)
 
 from devices import app as device_app
+device_app.install(metrics.Plugin('/api/0/devices'))
 app.mount("/api/0/devices", device_app)
 
 from security import app as security_app
+security_app.install(metrics.Plugin('/api/0/security'))
 app.mount("/api/0/security", security_app)
 
+from mirrors import app as mirrors_app
+mirrors_app.install(metrics.Plugin('/api/0/mirrors'))
+app.mount("/api/0/mirrors", mirrors_app)
+
+from events import app as events_app
+events_app.install(metrics.Plugin('/api/0/events'))
+app.mount("/api/0/events", events_app)
+
+application = profiling.wrap(app)
+
 
 def main():
-    run(app, host='', port='8081', reloader=True)
+    run(application, host='', port='8081', reloader=True)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Streaming tar.gz and zip archives of a job directory.
+
+The archive is generated while it is sent: every file is read and compressed in
+blocks straight from disk, so neither the archive nor any file is held in memory
+or written to a temp file. Chunkstore output files are archived by their logical
+name with their uncompressed content, the same way the file listing shows them.
+
+The zip is written the way streaming zippers do (sizes and crc in a data descriptor
+after each file), with zip64 records where an entry, an offset or the number of
+entries does not fit the classic ones.
+'''
+
+import fnmatch
+import os
+import struct
+import tarfile
+import time
+import zlib
+
+import chunkstore
+
+formats = {
+    'tar.gz': 'application/gzip',
+    'zip': 'application/zip'
+}
+block_size = 65536
+
+
+def entries(root, include=None, exclude=None):
+    '''yield (archive name, path, stat) of the files under root, filtered by the include/exclude globs.
+
+    Globs match the path relative to root; an excluded directory is not walked at all.'''
+    def matches(name, patterns):
+        return any(fnmatch.fnmatch(name, p) or fnmatch.fnmatch(os.path.basename(name), p) for p in patterns)
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel = os.path.relpath(dirpath, root)
+        rel = '' if rel == '.' else rel + '/'
+        dirnames[:] = sorted(d for d in dirnames if not (exclude and matches(rel + d, exclude)))
+        names = set(filenames)
+        for f in sorted(filenames):
+            path = os.path.join(dirpath, f)
+            if f.endswith('.gz.idx') and f[:-len('.idx')] in names:
+                continue  # archived with its chunkstore data below
+            elif f.endswith('.gz') and f + '.idx' in names:
+                f, path = f[:-len('.gz')], path[:-len('.gz')]
+            name = rel + f
+            if (include and not matches(name, include)) or (exclude and matches(name, exclude)):
+                continue
+            try:
+                st = os.stat(chunkstore.watch_path(path) if chunkstore.is_chunked(path) else path)
+            except OSError:
+                continue  # removed meanwhile
+            if os.path.isfile(path) or chunkstore.is_chunked(path):
+                yield name, path, st
+
+
+def contents(path, size=None):
+    '''yield the content of path in blocks, at most size bytes when given.'''
+    if chunkstore.is_chunked(path):
+        reader, offset = chunkstore.open_reader(path), 0
+        while size is None or offset < size:
+            data = reader.read(offset, block_size if size is None else min(block_size, size - offset))
+            if not data:
+                break
+            offset += len(data)
+            yield data
+        return
+    with open(path, 'rb') as f:
+        while size is None or size > 0:
+            data = f.read(block_size if size is None else min(block_size, size))
+            if not data:
+                break
+            if size is not None:
+                size -= len(data)
+            yield data
+
+
+def stream(root, format, include=None, exclude=None):
+    '''the archive of root in format, as an iterable of byte strings.'''
+    files = entries(root, include, exclude)
+    chunks = tar_gz_stream(files) if format == 'tar.gz' else zip_stream(files)
+    return (data for data in chunks if data)
+
+
+def tar_gz_stream(files):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    written = [0]
+
+    def out(data):
+        written[0] += len(data)
+        return compressor.compress(data)
+
+    for name, path, st in files:
+        info = tarfile.TarInfo(name)
+        info.size = chunkstore.open_reader(path).size() if chunkstore.is_chunked(path) else st.st_size
+        info.mtime, info.mode = int(st.st_mtime), st.st_mode & 0o7777
+        yield out(info.tobuf(tarfile.GNU_FORMAT))
+        sent = 0
+        try:
+            for data in contents(path, info.size):
+                sent += len(data)
+                yield out(data)
+        except (IOError, OSError):
+            pass
+        # the header has promised info.size bytes, a file that shrank meanwhile is padded with zeros.
+        padding = info.size - sent + (-info.size) % tarfile.BLOCKSIZE
+        if padding:
+            yield out(b'\0' * padding)
+    end = 2 * tarfile.BLOCKSIZE
+    end += (-(written[0] + end)) % tarfile.RECORDSIZE
+    yield out(b'\0' * end)
+    yield compressor.flush()
+
+
+def dos_time(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+def zip_stream(files):
+    '''the zip of files, with zip64 records for the entries, offsets and counts too big for the classic ones.'''
+    flags = 0x08 | 0x800  # sizes in a data descriptor, utf-8 names
+    offset, central = 0, []
+    for name, path, st in files:
+        arcname = name.encode('utf-8')
+        mtime, mdate = dos_time(st.st_mtime)
+        size_hint = chunkstore.open_reader(path).size() if chunkstore.is_chunked(path) else st.st_size
+        zip64 = size_hint + size_hint // 1000 + 1024 >= 0xffffffff  # deflate may grow incompressible data a little
+        if zip64:
+            extra = struct.pack('<HHQQ', 1, 16, 0, 0)
+            header = struct.pack('<IHHHHHIIIHH', 0x04034b50, 45, flags, zlib.DEFLATED, mtime, mdate, 0, 0xffffffff, 0xffffffff, len(arcname), len(extra)) + arcname + extra
+        else:
+            header = struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, flags, zlib.DEFLATED, mtime, mdate, 0, 0, 0, len(arcname), 0) + arcname
+        yield header
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        crc, compressed, size = 0, 0, 0
+        try:
+            for data in contents(path, size_hint):  # like tar, what was there when the entry started
+                crc, size = zlib.crc32(data, crc), size + len(data)
+                data = compressor.compress(data)
+                if data:
+                    compressed += len(data)
+                    yield data
+        except (IOError, OSError):
+            pass
+        data = compressor.flush()
+        compressed += len(data)
+        crc &= 0xffffffff
+        descriptor = struct.pack('<IIQQ' if zip64 else '<IIII', 0x08074b50, crc, compressed, size)
+        yield data + descriptor
+        central_extra = ([size, compressed] if zip64 else []) + ([offset] if offset >= 0xffffffff else [])
+        extra = struct.pack('<HH%dQ' % len(central_extra), 1, 8 * len(central_extra), *central_extra) if central_extra else b''
+        central.append(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | (45 if extra else 20), 45 if extra else 20, flags, zlib.DEFLATED,
+                                   mtime, mdate, crc, 0xffffffff if zip64 else compressed, 0xffffffff if zip64 else size,
+                                   len(arcname), len(extra), 0, 0, 0, (st.st_mode & 0xffff) << 16, min(offset, 0xffffffff)) + arcname + extra)
+        offset += len(header) + compressed + len(descriptor)
+    directory = b''.join(central)
+    count = len(central)
+    end = b''
+    if count >= 0xffff or len(directory) >= 0xffffffff or offset >= 0xffffffff:
+        end = (struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, (3 << 8) | 45, 45, 0, 0, count, count, len(directory), offset) +
+               struct.pack('<IIQI', 0x07064b50, 0, offset + len(directory), 1))
+    yield directory + end + struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xffff), min(count, 0xffff),
+                                        min(len(directory), 0xffffffff), min(offset, 0xffffffff), 0)
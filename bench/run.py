@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Load benchmarks of the server, against fake devices.
+
+    python bench/run.py --devices 8 --latency 0.01 --duration 5 --save baseline.json
+    python bench/run.py --compare baseline.json
+
+The server runs in process on a threaded wsgiref server, with its jobs (and a synthetic
+job history) in a temp directory. The devices are simulated by fake_adb.FakeAdbServer,
+with the given command latency and screencap size, and bench/bin/adb is put first on
+the PATH for the few calls the server makes to the adb binary.
+
+Every profile runs for --duration seconds with --concurrency clients, and reports its
+throughput and p50/p99 latency; the stream profile reports the time to first byte of
+--stream-clients followers of one job and the bytes per second they got altogether.
+With --compare, a profile whose throughput dropped or whose p99 grew by more than
+--tolerance against the baseline is reported as a regression, and the exit code is 1.
+'''
+
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(bench_dir))
+import fake_adb
+
+profiles = ['devices', 'stat', 'screenshot', 'jobs_history', 'job_create_stop', 'stream']
+
+
+class Server(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+def start(args, workdir):
+    '''the fake devices and the server; returns the server port and the serials.'''
+    screen = [int(v) for v in args.screen.split('x')]
+    devices = [fake_adb.FakeDevice('bench%04d' % i, latency=args.latency, screen=screen) for i in range(args.devices)]
+    adb_server = fake_adb.FakeAdbServer(('127.0.0.1', 0), devices)
+    adb_server.serve_in_background()
+    os.environ['ANDROID_ADB_SERVER_PORT'] = str(adb_server.server_address[1])
+    os.environ['PATH'] = os.path.join(bench_dir, 'bin') + os.pathsep + os.environ.get('PATH', '')
+
+    import adb
+    import app
+    import jobs
+    import mirrors
+    jobs.app.config['jobs.path'] = os.path.join(workdir, 'jobs')
+    jobs.app.config['jobs.venv_cache'] = os.path.join(workdir, 'venvs')
+    mirrors.app.config['mirrors.enabled'] = False
+
+    server = make_server('127.0.0.1', 0, app.application, Server, QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    adb.tracker.start_once()
+    adb.tracker.synced.wait(10)
+    return server.server_address[1], [d.serial for d in devices]
+
+
+def synthetic_history(jobs_path, count, serials):
+    '''count finished jobs, as job.json files the history index gets rebuilt from.'''
+    now = time.time()
+    for i in range(count):
+        job_id = 'history-%08d' % i
+        started = now - (count - i) * 60
+        info = {
+            'job_id': job_id,
+            'job_path': os.path.join(jobs_path, job_id),
+            'repo': {'url': 'https://example.com/repo%d.git' % (i % 20)},
+            'env': {'ANDROID_SERIAL': serials[i % len(serials)]},
+            'exclusive': True,
+            'started_at': str(started),
+            'finished_at': str(started + 30),
+            'exit_code': 0 if i % 10 else 1
+        }
+        os.makedirs(info['job_path'])
+        with open(os.path.join(info['job_path'], 'job.json'), 'w') as f:
+            f.write(json.dumps(info, sort_keys=True, indent=2))
+
+
+def call(port, method, path, body=None):
+    conn = httplib.HTTPConnection('127.0.0.1', port, timeout=60)
+    try:
+        conn.request(method, path, json.dumps(body) if body is not None else None,
+                     {'Content-Type': 'application/json'} if body is not None else {})
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def operations(port, serials):
+    '''profile name -> one operation of that profile, returning whether it succeeded.'''
+    sizes = [(w, w * 5 // 3) for w in (120, 160, 240, 320, 360, 480, 600, 720)]
+
+    def get(path):
+        return call(port, 'GET', path)[0] == 200
+
+    def create_and_stop():
+        job_id = 'bench-%s' % uuid.uuid4()
+        status, body = call(port, 'POST', '/api/0/jobs/%s' % job_id, {
+            'repo': {'url': '/nonexistent/bench.git'},  # the job fails right after spawning, as cheap as a job gets
+            'env': {'ANDROID_SERIAL': random.choice(serials)},
+            'exclusive': False
+        })
+        return status in (200, 202) and call(port, 'DELETE', '/api/0/jobs/%s' % job_id)[0] in (200, 410)
+
+    return {
+        'devices': lambda: get('/api/0/devices/'),
+        'stat': lambda: get('/api/0/devices/%s/stat' % random.choice(serials)),
+        'screenshot': lambda: get('/api/0/devices/%s/screenshot?width=%d&height=%d' % ((random.choice(serials),) + random.choice(sizes))),
+        'jobs_history': lambda: get('/api/0/jobs/?all=true&limit=50' + random.choice(['', '&serial=%s' % random.choice(serials), '&exit_code=1'])),
+        'job_create_stop': create_and_stop
+    }
+
+
+def load(operation, concurrency, duration):
+    latencies, errors, lock = [], [0], threading.Lock()
+    deadline = time.time() + duration
+
+    def client():
+        while time.time() < deadline:
+            started = time.time()
+            try:
+                ok = operation()
+            except (socket.error, httplib.HTTPException):
+                ok = False
+            elapsed = time.time() - started
+            with lock:
+                latencies.append(elapsed)
+                if not ok:
+                    errors[0] += 1
+
+    started = time.time()
+    threads = [threading.Thread(target=client) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return summary(latencies, errors[0], len(latencies) / (time.time() - started), 'req/s')
+
+
+def stream_fanout(port, jobs_path, clients, seconds):
+    '''clients following the output of one job while it writes for seconds.'''
+    import jobs
+    job_id = 'bench-stream-%s' % uuid.uuid4()
+    job_path = os.path.join(jobs_path, job_id)
+    os.makedirs(job_path)
+    job = {'job_info': {'job_id': job_id, 'env': {'ANDROID_SERIAL': 'no_device'}, 'exclusive': False, 'job_path': job_path}, 'lock': threading.Lock()}
+    with open(os.path.join(job_path, 'job.json'), 'w') as f:
+        f.write(json.dumps(job['job_info']))
+    output = os.path.join(job_path, 'output')
+    open(output, 'w').close()
+    jobs.registry.add(job)
+
+    def write():
+        with open(output, 'ab') as f:
+            n, deadline = 0, time.time() + seconds
+            while time.time() < deadline:
+                f.write(b''.join(b'line %08d of the benchmark job output\n' % (n + i) for i in range(200)))
+                f.flush()
+                n += 200
+                time.sleep(0.01)
+        jobs.registry.remove(job)
+
+    first_bytes, received, lock = [], [], threading.Lock()
+
+    def follow():
+        started, size, first = time.time(), 0, None
+        conn = httplib.HTTPConnection('127.0.0.1', port, timeout=60)
+        try:
+            conn.request('GET', '/api/0/jobs/%s/stream?offset=0' % job_id)
+            response = conn.getresponse()
+            while True:
+                data = response.read(65536)
+                if not data:
+                    break
+                if first is None:
+                    first = time.time() - started
+                size += len(data)
+        except (socket.error, httplib.HTTPException):
+            pass
+        finally:
+            conn.close()
+        with lock:
+            first_bytes.append(first if first is not None else float('inf'))
+            received.append(size)
+
+    threads = [threading.Thread(target=follow) for i in range(clients)]
+    started = time.time()
+    for t in threads:
+        t.start()
+    write()
+    for t in threads:
+        t.join()
+    expected = os.path.getsize(output)
+    return summary(first_bytes, sum(1 for size in received if size != expected), sum(received) / (time.time() - started) / 1e6, 'MB/s')
+
+
+def summary(latencies, errors, throughput, unit):
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return round(latencies[int(p * (len(latencies) - 1))] * 1000, 2) if latencies else None
+    return {'requests': len(latencies), 'errors': errors, 'throughput': round(throughput, 2), 'unit': unit,
+            'p50_ms': percentile(0.5), 'p99_ms': percentile(0.99)}
+
+
+def report(results, baseline=None, tolerance=0.2):
+    '''print the results, against the baseline if any; returns the names of the regressed profiles.'''
+    regressions = []
+    print('%-16s %8s %7s %12s %10s %10s  %s' % ('profile', 'requests', 'errors', 'throughput', 'p50 ms', 'p99 ms', 'vs baseline' if baseline else ''))
+    for name, r in results.items():
+        line = '%-16s %8d %7d %7.2f %-4s %10s %10s' % (name, r['requests'], r['errors'], r['throughput'], r['unit'], r['p50_ms'], r['p99_ms'])
+        base = (baseline or {}).get(name)
+        if base:
+            throughput = (r['throughput'] - base['throughput']) / base['throughput'] if base['throughput'] else 0
+            p99 = (r['p99_ms'] - base['p99_ms']) / base['p99_ms'] if base['p99_ms'] else 0
+            regressed = throughput < -tolerance or p99 > tolerance
+            line += '  throughput %+.0f%%, p99 %+.0f%%%s' % (throughput * 100, p99 * 100, '  REGRESSION' if regressed else '')
+            if regressed:
+                regressions.append(name)
+        print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='load benchmarks of the server against fake devices')
+    parser.add_argument('--profiles', default=','.join(profiles), help='comma separated, among %s' % ', '.join(profiles))
+    parser.add_argument('--duration', type=float, default=5, help='seconds per profile')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--devices', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds per adb command on the fake devices')
+    parser.add_argument('--screen', default='480x800', help='WIDTHxHEIGHT of the screencap payloads')
+    parser.add_argument('--history', type=int, default=20000, help='finished jobs in the synthetic history')
+    parser.add_argument('--stream-clients', type=int, default=50)
+    parser.add_argument('--stream-seconds', type=float, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='write the results to this baseline file')
+    parser.add_argument('--compare', help='compare the results with this baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative change reported as a regression')
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    try:
+        port, serials = start(args, workdir)
+        jobs_path = os.path.join(workdir, 'jobs')
+        synthetic_history(jobs_path, args.history, serials)
+        started = time.time()
+        call(port, 'GET', '/api/0/jobs/?all=true&limit=1')  # builds the history index from the job.json files
+        print('history of %d jobs indexed in %.2fs' % (args.history, time.time() - started))
+
+        ops, results = operations(port, serials), OrderedDict()
+        for name in args.profiles.split(','):
+            if name == 'stream':
+                results[name] = stream_fanout(port, jobs_path, args.stream_clients, args.stream_seconds)
+            elif name in ops:
+                ops[name]()  # warm up
+                results[name] = load(ops[name], args.concurrency, args.duration)
+            else:
+                parser.error('unknown profile %s' % name)
+
+        baseline = None
+        if args.compare:
+            with open(args.compare) as f:
+                baseline = json.load(f)['results']
+        regressions = report(results, baseline, args.tolerance)
+        if args.save:
+            with open(args.save, 'w') as f:
+                f.write(json.dumps({'config': vars(args), 'results': results}, sort_keys=True, indent=2))
+        return 1 if regressions else 0
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Compressed, chunk indexed storage of job output.
+
+A stored file `output` is written as `output.gz`, a concatenation of independent gzip
+members (so plain `zcat output.gz` still works), and `output.gz.idx`, one fixed size
+record per member: raw offset, compressed offset, raw length, compressed length and
+newline count. Reading a byte range only decompresses the members it overlaps, and
+finding where a line starts only the member holding it.
+
+The writer runs as its own process between the job and the disk:
+
+    some_job | python chunkstore.py write /path/to/output
+
+It stops at the end of its input, or on SIGTERM, after writing out what it buffered.
+'''
+
+import bisect
+import os
+import select
+import signal
+import struct
+import sys
+import time
+import zlib
+
+record = struct.Struct('<QQIII')
+chunk_size = 256 * 1024  # raw bytes per gzip member
+flush_interval = 1.0  # seconds before buffered output is written out even if the chunk is not full
+
+
+def is_chunked(path):
+    return os.path.exists(path + '.gz.idx')
+
+
+def exists(path):
+    return os.path.exists(path) or is_chunked(path)
+
+
+def create(path):
+    '''create the empty store, so that readers find it before the writer process gets going.'''
+    for filename in (path + '.gz', path + '.gz.idx'):
+        open(filename, 'wb').close()
+
+
+def writer_command(path):
+    return [sys.executable, os.path.splitext(os.path.abspath(__file__))[0] + '.py', 'write', path]
+
+
+def write(path, stream, stop=None):
+    '''compress everything read from the stream fd into path.gz + path.gz.idx, until its end or until the stop fd is readable.'''
+    fd = stream.fileno()
+    raw_offset, comp_offset, buffered, deadline = 0, 0, [], None
+    with open(path + '.gz', 'wb') as data_f:
+        with open(path + '.gz.idx', 'wb') as idx_f:
+            def flush():
+                raw = b''.join(buffered)
+                del buffered[:]
+                compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+                comp = compressor.compress(raw) + compressor.flush()
+                data_f.write(comp)
+                data_f.flush()
+                idx_f.write(record.pack(raw_offset, comp_offset, len(raw), len(comp), raw.count(b'\n')))
+                idx_f.flush()  # readers trust the index only, so it goes after the data
+                return len(raw), len(comp)
+
+            eof = False
+            while not eof:
+                timeout = max(deadline - time.time(), 0) if deadline else None
+                ready = select.select([fd] if stop is None else [fd, stop], [], [], timeout)[0]
+                if stop in ready:
+                    eof = True
+                elif ready:
+                    data = os.read(fd, 65536)
+                    if data:
+                        buffered.append(data)
+                        deadline = deadline or time.time() + flush_interval
+                    else:
+                        eof = True
+                if buffered and (eof or time.time() >= deadline or sum(len(b) for b in buffered) >= chunk_size):
+                    raw_len, comp_len = flush()
+                    raw_offset, comp_offset, deadline = raw_offset + raw_len, comp_offset + comp_len, None
+
+
+class ChunkReader(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.records = []
+        self.starts = []  # raw offset of every chunk, for bisect
+        self.newlines = []  # newlines up to the end of every chunk, for bisect
+        self._idx_pos = 0
+        self._cache = (None, None)  # (chunk number, raw bytes) of the last decompressed chunk
+        self.refresh()
+
+    def refresh(self):
+        '''pick up the chunks appended since the last call.'''
+        with open(self.path + '.gz.idx', 'rb') as f:
+            f.seek(self._idx_pos)
+            data = f.read()
+        usable = len(data) - len(data) % record.size
+        for pos in range(0, usable, record.size):
+            r = record.unpack_from(data, pos)
+            self.records.append(r)
+            self.starts.append(r[0])
+            self.newlines.append((self.newlines[-1] if self.newlines else 0) + r[4])
+        self._idx_pos += usable
+
+    def size(self):
+        return self.records[-1][0] + self.records[-1][2] if self.records else 0
+
+    def chunk(self, i):
+        if self._cache[0] != i:
+            raw_offset, comp_offset, raw_len, comp_len, lines = self.records[i]
+            with open(self.path + '.gz', 'rb') as f:
+                f.seek(comp_offset)
+                self._cache = (i, zlib.decompress(f.read(comp_len), 31))
+        return self._cache[1]
+
+    def line_offset(self, n):
+        '''byte offset where line n (from 0) starts, the size if there are not as many.'''
+        if n <= 0:
+            return 0
+        i = bisect.bisect_left(self.newlines, n)  # the chunk holding the newline ending line n - 1
+        if i == len(self.records):
+            return self.size()
+        data, index = self.chunk(i), -1
+        for _ in range(n - (self.newlines[i - 1] if i else 0)):
+            index = data.index(b'\n', index + 1)
+        return self.starts[i] + index + 1
+
+    def read(self, offset, size):
+        result = []
+        i = bisect.bisect_right(self.starts, offset) - 1
+        while size > 0 and 0 <= i < len(self.records):
+            data = self.chunk(i)[offset - self.starts[i]:offset - self.starts[i] + size]
+            if not data:
+                break
+            result.append(data)
+            offset, size, i = offset + len(data), size - len(data), i + 1
+        return b''.join(result)
+
+
+class PlainReader(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def refresh(self):
+        pass
+
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def read(self, offset, size):
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+
+def open_reader(path):
+    '''a reader with size() and read(offset, size) for path, however it is stored.'''
+    return ChunkReader(path) if is_chunked(path) else PlainReader(path)
+
+
+def watch_path(path):
+    '''the file that grows when path gets new content.'''
+    return path + '.gz.idx' if is_chunked(path) else path
+
+
+def main():
+    if len(sys.argv) != 3 or sys.argv[1] != 'write':
+        sys.exit('usage: %s write <path>' % sys.argv[0])
+    stop_r, stop_w = os.pipe()
+    signal.signal(signal.SIGTERM, lambda signum, frame: os.write(stop_w, b'x'))
+    write(sys.argv[2], sys.stdin, stop_r)
+
+if __name__ == '__main__':
+    main()
@@ -1,31 +1,73 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from bottle import Bottle, request, static_file, abort
-import re
+from bottle import Bottle, request, response, abort
+import json
+import threading
 import time
-import os
-import subprocess
-from io import BytesIO
-try:
-    import PIL.Image as Image
-except:
-    from PIL import Image
-
-from jobs import lock
+
 import adb
+import adb_client
+import events
+import scheduler
+import screen
+import stats
 
 app = Bottle()
+app.config.setdefault('devices.max_workers', 8)
+app.config.setdefault('devices.stat_interval', 10)  # seconds between background stat samples, 0 to disable
+
+_props = {}  # serial -> static "ro.*" props, kept only while the device stays attached.
+_props_lock = threading.Lock()
+
+
+def _forget_props(event):
+    with _props_lock:
+        _props.pop(event['serial'], None)
+
+adb.tracker.subscribe(_forget_props)
+
+
+def _track_samplers(event):
+    interval = float(app.config.get('devices.stat_interval'))
+    if event['status'] == 'device' and interval > 0:
+        stats.start(event['serial'], interval)
+    elif event['status'] != 'device':
+        stats.stop(event['serial'])
+
+adb.tracker.subscribe(_track_samplers)
+
+
+def _publish_device_event(event):
+    type = 'device.attached' if event['previous'] is None else 'device.detached' if event['status'] is None else 'device.changed'
+    events.publish(type, event, duplicated=True)
+
+adb.tracker.subscribe(_publish_device_event)
+
+
+def static_props(serials):
+    with _props_lock:
+        for se in [se for se in _props if se not in serials]:
+            del _props[se]
+        missing = [se for se in serials if se not in _props]
+    for se, props, error in adb.parallel(adb.getprop, missing, app.config.get('devices.max_workers')):
+        if props:
+            with _props_lock:
+                _props[se] = dict((k, v) for k, v in props.items() if k.startswith('ro.'))
+    with _props_lock:
+        return dict((se, _props.get(se, {})) for se in serials)
 
 
 @app.get("/")
 def devices():
     result = {'android': []}
-    good_devices = adb.devices(status='good')
-    for se, name in adb.devices(status=request.params.get("status", "all")).items():
+    all_devices = adb.devices()
+    good_devices = adb.filter_status(all_devices, 'good')
+    props_of = static_props(list(good_devices))
+    for se, name in adb.filter_status(all_devices, request.params.get("status", "all")).items():
         device = {'adb': {'serial': se, 'device': name}}
         if se in good_devices:
-            props = adb.getprop(se)
+            props = props_of[se]
             device.update({
                 'product': {
                     'brand': props.get('ro.product.brand'),
@@ -61,41 +103,102 @@ def adb_cmd(serial, cmds):
     return adb.cmd(['-s', serial] + cmds.split("/"), timeout=request.params.get("timeout", 10))
 
 
-def meminfo(serial):
-    result = {}
-    for line in adb.cmd(['-s', serial, 'shell', 'cat', '/proc/meminfo'])['stdout'].splitlines():
-        item = [i.strip() for i in line.split(':')]
-        if len(item) == 2:
-            values = item[1].split()
-            result[item[0]] = int(values[0])*1024 if len(values) == 2 and values[1] == 'kB' else int(values[0])
-    return result
+@app.post("/batch")
+def batch():
+    '''run one adb command on many devices at once.
 
+    {"cmds": ["shell", "logcat", "-c"], "devices": [serials], "status": "ok", "props": {"ro.product.model": ...},
+     "timeout": 10, "concurrency": 8, "stream": false}
 
-def top(serial):
-    result = {"processes": []}
-    out = adb.cmd(['-s', serial, 'shell', 'top', '-n', '1'])['stdout']
-    m = re.search(r'User\s*(\d+)%,\s*System\s*(\d+)%,\s*IOW\s*(\d+)%,\s*IRQ\s*(\d+)%', out)
-    if m:
-        result["CPU"] = {"User": int(m.group(1))/100., "System": int(m.group(2))/100., "IOW": int(m.group(3))/100., "IRQ": int(m.group(4))/100.}
-    for item in re.findall(r'(\d+)\s+(\d+)\s+(\d+)%\s+(\w+)\s+(\d+)\s+(\d+)K\s+(\d+)K\s+(fg|bg)?\s+(\S+)\s+(\S+)', out):
-        pid, pr, cpu, s, thr, vss, rss, pcy, uid, name = item
-        result["processes"].append({"pid": int(pid), "pr": int(pr), "cpu": int(cpu)/100., "s": s, "thr": int(thr), "vss": int(vss)*1024, "rss": int(rss)*1024, "pcy": pcy, "uid": uid, "name": name})
-    return result
+    The devices are the listed ones, else the attached ones with the status; either way,
+    only those matching props if given. The results are {"results": {serial: result}},
+    or one json line per device as soon as it is done with "stream": true.'''
+    body = request.json or {}
+    cmds = body.get('cmds')
+    if not isinstance(cmds, list) or not cmds:
+        abort(400, 'The "cmds" list is mandatory!')
+    timeout = float(body.get('timeout', 10))
+    max_workers = int(app.config.get('devices.max_workers'))
+    size = min(int(body.get('concurrency', max_workers)), max_workers)
+    serials, results = select(body.get('devices'), body.get('status', 'ok'), body.get('props'))
+
+    def run(serial):
+        started = time.time()
+        result = adb.cmd(['-s', serial] + [str(c) for c in cmds], timeout=timeout)
+        return dict(result, stdout=text(result['stdout']), stderr=text(result['stderr']), elapsed=round(time.time() - started, 3))
+
+    def completed():
+        for serial, error in sorted(results.items()):
+            yield serial, {'error': error}
+        for serial, result, error in adb.parallel(run, serials, size):
+            yield serial, result if error is None else {'error': str(error)}
+    if body.get('stream'):
+        response.content_type = 'application/x-ndjson'
+        return ((json.dumps(dict(result, serial=serial), sort_keys=True) + '\n').encode('utf-8') for serial, result in completed())
+    return {'results': dict(completed())}
+
+
+def select(serials, status, props):
+    '''the serials to run on, and {serial: error} for the listed ones that cannot run.'''
+    all_devices = adb.devices()
+    good = adb.filter_status(all_devices, 'good')
+    errors = {}
+    if serials is None:
+        selected = list(adb.filter_status(all_devices, status))
+    else:
+        errors = dict((se, 'No specified device attached!') for se in serials if se not in good)
+        selected = [se for se in serials if se in good]
+    if props:
+        props_of = static_props(list(good))
+        selected = [se for se in selected if se in props_of and scheduler.matches(props_of[se], props)]
+    return sorted(set(selected)), errors
+
+
+def text(data):
+    return data.decode('utf-8', 'replace') if isinstance(data, bytes) else data
 
 
 @app.get("/<serial>/stat")
 def stat(serial):
-    return {"meminfo": meminfo(serial), "top": top(serial)}
+    '''the latest background sample when fresh, else a new one.'''
+    sample = stats.latest(serial, float(app.config.get('devices.stat_interval'))) or stats.sample(serial)
+    return {"meminfo": sample['meminfo'], "top": sample['top']}
+
+
+@app.get("/<serial>/stat/history")
+def stat_history(serial):
+    '''the sampled stats since ?since= (epoch seconds), averaged into ?step= seconds buckets if given.'''
+    adb.tracker.start_once()
+    history = stats.history(serial)
+    if history is None:
+        abort(404, 'No stats sampled for the specified device!')
+    step = float(request.params.get('step', 0))
+    return {
+        'interval': float(app.config.get('devices.stat_interval')),
+        'step': step or None,
+        'samples': history.query(float(request.params.get('since', 0)), step)
+    }
+
 
 @app.get("/<serial>/screenshot")
-@lock
 def screenshot(serial):
     size = (int(request.params.get('width', 480)), int(request.params.get('height', 480)))
-    thumbnail = '%s(%dx%d).thumbnail.png' % (serial, size[0], size[1])
-    if not os.path.exists('/tmp/%s' % thumbnail) or time.time() - os.stat('/tmp/%s' % thumbnail).st_mtime > 5:
-        p1 = subprocess.Popen(["adb", "-s", serial, "shell", "screencap", "-p"], stdout=subprocess.PIPE)
-        p2 = subprocess.Popen(["sed", "s/\r$//"], stdout=subprocess.PIPE, stdin=p1.stdout)
-        im = Image.open(BytesIO(p2.communicate()[0]))
-        im.thumbnail(size, Image.ANTIALIAS)
-        im.save('/tmp/%s' % thumbnail)
-    return static_file(thumbnail, root='/tmp')
+    format = request.params.get('format', 'png').lower()
+    if format not in screen.formats:
+        abort(400, 'Unsupported image format %s!' % format)
+    try:
+        data, content_type = screen.thumbnail(serial, size, format)
+    except (adb_client.AdbError, ValueError) as e:
+        abort(404, str(e))
+    response.content_type = content_type
+    return data
+
+
+@app.get("/<serial>/screen/stream")
+def screen_stream(serial):
+    if serial not in adb.devices(status='ok'):
+        abort(404, 'No specified device attached!')
+    size = (int(request.params.get('width', 480)), int(request.params.get('height', 480)))
+    fps = min(max(float(request.params.get('fps', 2)), 0.1), screen.max_fps)
+    response.content_type = 'multipart/x-mixed-replace; boundary=%s' % screen.boundary
+    return screen.stream(serial, size, fps)
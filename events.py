@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Change events of the server (jobs started/finished, devices attached/detached/changed),
+published as a server-sent event stream at /api/0/events.
+
+Every event has an increasing id; a client reconnecting with Last-Event-ID (or ?last_id=)
+gets the events it missed as long as they are still among the latest `backlog`, or a
+"resync" event telling it to fetch the whole state again otherwise.
+'''
+
+from bottle import Bottle, request, response
+import json
+import threading
+import time
+from collections import deque
+
+app = Bottle()
+
+backlog = 1000  # latest events kept for reconnecting clients
+keepalive = 15  # seconds between comments on an idle stream, so that dead clients get noticed
+
+_events = deque(maxlen=backlog)
+_condition = threading.Condition()
+_last_id = [0]
+
+relay = None  # jobstore.EventRelay when several workers share their events
+
+
+def publish(type, data, duplicated=False):
+    '''duplicated: every worker publishes this same event, only one copy of it is kept.'''
+    if relay is not None:
+        relay.publish(type, data, duplicated)
+    else:
+        append(None, type, time.time(), data)
+
+
+def append(id, type, at, data):
+    '''add an event for the streams, with the next id if id is None.'''
+    with _condition:
+        _last_id[0] = _last_id[0] + 1 if id is None else id
+        _events.append({'id': _last_id[0], 'type': type, 'time': at, 'data': data})
+        _condition.notify_all()
+
+
+def since(last_id):
+    '''the events after last_id, None if some of them are gone already.'''
+    with _condition:
+        if _events and last_id < _events[0]['id'] - 1 or last_id > _last_id[0]:
+            return None
+        return [e for e in _events if e['id'] > last_id]
+
+
+def wait(last_id, timeout):
+    with _condition:
+        if _last_id[0] <= last_id:
+            _condition.wait(timeout)
+        return _last_id[0]
+
+
+def format_event(event):
+    return ('id: %d\nevent: %s\ndata: %s\n\n' % (event['id'], event['type'], json.dumps(event['data'], sort_keys=True))).encode('utf-8')
+
+
+def stream(last_id):
+    if relay is not None:
+        relay.start()
+    if last_id is None:
+        last_id = _last_id[0]
+        yield ('id: %d\nevent: hello\ndata: {}\n\n' % last_id).encode('utf-8')
+    while True:
+        events = since(last_id)
+        if events is None:
+            last_id = _last_id[0]
+            yield ('id: %d\nevent: resync\ndata: {}\n\n' % last_id).encode('utf-8')
+            continue
+        for event in events:
+            yield format_event(event)
+            last_id = event['id']
+        if wait(last_id, keepalive) <= last_id:
+            yield b': keepalive\n\n'
+
+
+@app.get("/")
+def events():
+    '''the change events as text/event-stream, from Last-Event-ID (or ?last_id=) on if given.'''
+    last_id = request.get_header('Last-Event-ID', request.params.get('last_id'))
+    response.content_type = 'text/event-stream'
+    response.set_header('Cache-Control', 'no-cache')
+    return stream(int(last_id) if last_id is not None else None)
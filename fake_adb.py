@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''A fake adb server speaking the adb wire protocol, for exercising the server without phones.
+
+    python fake_adb.py --port 5037 --devices 20 --latency 0.05
+    python fake_adb.py --scenario devices.json
+
+A scenario file is a json list of devices, each one like
+{"serial": "...", "state": "device", "props": {...}, "files": {path: content},
+ "commands": {command: output}, "latency": 0.05, "screen": [480, 800]}.
+'''
+
+import argparse
+import json
+import shlex
+import struct
+import threading
+import time
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from adb_client import request, read_exact
+
+MEMINFO = '''MemTotal:         1882524 kB
+MemFree:           146488 kB
+Buffers:            23460 kB
+Cached:            623316 kB
+SwapCached:             0 kB
+'''
+
+TOP = '''
+
+User 12%, System 5%, IOW 0%, IRQ 0%
+User 38 + Nice 0 + Sys 16 + Idle 246 + IOW 0 + IRQ 0 + SIRQ 0 = 300
+
+  PID PR CPU% S  #THR     VSS     RSS PCY UID      Name
+ 2313  0   7% R     1   1216K    520K  fg shell    top
+  552  1   3% S    84 999832K 118436K  fg system   system_server
+    1  0   0% S     1    736K    572K  fg root     /init
+'''
+
+
+class FakeDevice(object):
+
+    def __init__(self, serial, state='device', props=None, files=None, commands=None, latency=0, screen=(480, 800)):
+        self.serial = serial
+        self.state = state
+        self.props = {
+            'ro.product.brand': 'fake',
+            'ro.product.manufacturer': 'fake',
+            'ro.product.model': 'Fake %s' % serial,
+            'ro.build.version.sdk': '19',
+            'ro.build.version.release': '4.4.2',
+            'ro.serialno': serial
+        }
+        self.props.update(props or {})
+        self.files = {'/proc/meminfo': MEMINFO}
+        self.files.update(files or {})
+        self.commands = commands or {}
+        self.latency = float(latency)
+        self.screen = tuple(screen)
+        self.frame = 0
+
+    def framebuffer(self):
+        '''raw `screencap` output: width, height, format (RGBA_8888) then the pixels; every call is a new frame.'''
+        self.frame += 1
+        width, height = self.screen
+        row = bytearray(width * 4)
+        for x in range(width):
+            row[x * 4:x * 4 + 4] = bytearray([(x + self.frame * 8) % 256, (x * 3) % 256, self.frame % 256, 255])
+        return struct.pack('<III', width, height, 1) + bytes(row) * height
+
+    def run(self, command):
+        '''a tiny shell: `;` separated builtins, with $? expanded. Returns (output, returncode).'''
+        if self.latency:
+            time.sleep(self.latency)
+        out, rc = b'', 0
+        for part in command.split(';'):
+            part = part.strip().replace('$?', str(rc))
+            if not part:
+                continue
+            if part in self.commands:
+                output, rc = self.commands[part], 0
+                out += output.encode('utf-8') if not isinstance(output, bytes) else output
+                continue
+            args = shlex.split(part)
+            output, rc = self.builtin(args[0], args[1:])
+            out += output
+        return out, rc
+
+    def builtin(self, name, args):
+        if name == 'getprop':
+            if args:
+                return ('%s\n' % self.props.get(args[0], '')).encode('utf-8'), 0
+            return ''.join('[%s]: [%s]\n' % item for item in sorted(self.props.items())).encode('utf-8'), 0
+        elif name == 'cat':
+            if args and args[0] in self.files:
+                content = self.files[args[0]]
+                return content if isinstance(content, bytes) else content.encode('utf-8'), 0
+            return ('%s: No such file or directory\n' % (args[0] if args else '')).encode('utf-8'), 1
+        elif name == 'top':
+            return TOP.encode('utf-8'), 0
+        elif name == 'screencap':
+            return self.framebuffer(), 0
+        elif name == 'echo':
+            return (' '.join(args) + '\n').encode('utf-8'), 0
+        elif name == 'printf':
+            fmt = args[0].replace('\\n', '\n') if args else ''
+            return (fmt.replace('%s', args[1]) if len(args) > 1 else fmt).encode('utf-8'), 0
+        elif name == 'sleep':
+            time.sleep(float(args[0]) if args else 0)
+            return b'', 0
+        elif name in ('true', 'false'):
+            return b'', int(name == 'false')
+        return ('/system/bin/sh: %s: not found\n' % name).encode('utf-8'), 127
+
+
+class FakeAdbServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), devices=()):
+        socketserver.ThreadingTCPServer.__init__(self, address, Handler)
+        self.devices = dict((d.serial, d) for d in devices)
+        self.trackers = []
+        self.lock = threading.Lock()
+
+    def device_list(self):
+        with self.lock:
+            return ''.join('%s\t%s\n' % (d.serial, d.state) for d in self.devices.values())
+
+    def notify(self):
+        message = request(self.device_list())
+        with self.lock:
+            trackers = list(self.trackers)
+        for wfile in trackers:
+            try:
+                wfile.write(message)
+                wfile.flush()
+            except Exception:
+                with self.lock:
+                    if wfile in self.trackers:
+                        self.trackers.remove(wfile)
+
+    def add_device(self, device):
+        with self.lock:
+            self.devices[device.serial] = device
+        self.notify()
+
+    def remove_device(self, serial):
+        with self.lock:
+            self.devices.pop(serial, None)
+        self.notify()
+
+    def set_state(self, serial, state):
+        with self.lock:
+            self.devices[serial].state = state
+        self.notify()
+
+    def serve_in_background(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+
+class Handler(socketserver.StreamRequestHandler):
+
+    def okay(self, payload=None):
+        self.wfile.write(b'OKAY' + (request(payload) if payload is not None else b''))
+        self.wfile.flush()
+
+    def fail(self, message):
+        self.wfile.write(b'FAIL' + request(message))
+        self.wfile.flush()
+
+    def handle(self):
+        server = self.server
+        device = None
+        while True:
+            try:
+                service = read_exact(self.request, int(read_exact(self.request, 4), 16)).decode('utf-8')
+            except (EOFError, ValueError):
+                return
+            if device is None:
+                if service == 'host:version':
+                    return self.okay('0020')
+                elif service == 'host:devices':
+                    return self.okay(server.device_list())
+                elif service == 'host:track-devices':
+                    self.okay(server.device_list())
+                    with server.lock:
+                        server.trackers.append(self.wfile)
+                    while self.request.recv(1):
+                        pass
+                    return
+                elif service.startswith('host:transport:'):
+                    device = server.devices.get(service[len('host:transport:'):])
+                    if device is None or device.state != 'device':
+                        return self.fail("device '%s' not found" % service[len('host:transport:'):])
+                    self.okay()
+                else:
+                    return self.fail('unknown host service %s' % service)
+            elif service.startswith('shell:') or service.startswith('exec:'):
+                self.okay()
+                self.wfile.write(device.run(service.split(':', 1)[1])[0])
+                return
+            else:
+                return self.fail('closed')
+
+
+def load_devices(args):
+    if args.scenario:
+        with open(args.scenario) as f:
+            return [FakeDevice(**d) for d in json.load(f)]
+    screen = [int(v) for v in args.screen.split('x')]
+    return [FakeDevice('fake%04d' % i, latency=args.latency, screen=screen) for i in range(args.devices)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='fake adb server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5037)
+    parser.add_argument('--devices', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--screen', default='480x800', help='WIDTHxHEIGHT of the screencap payloads')
+    parser.add_argument('--scenario')
+    args = parser.parse_args()
+    FakeAdbServer((args.host, args.port), load_devices(args)).serve_forever()
+
+if __name__ == '__main__':
+    main()
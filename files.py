@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Serving and listing of the files in the job directories.
+
+Files are served with ETag/Last-Modified validators and single byte range
+requests (Range, If-Range), so an interrupted download of a big file can resume.
+A plain file is returned as a file object seeked to the start of the range,
+which the WSGI server sends with sendfile through wsgi.file_wrapper.
+'''
+
+from bottle import request, response, abort
+import calendar
+import itertools
+import mimetypes
+import os
+from email.utils import formatdate, parsedate
+
+import chunkstore
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+block_size = 65536
+
+
+def entries(path):
+    '''[(name, is_dir)] of a directory, without a stat per entry whenever the os tells the type.'''
+    if scandir is None:
+        return [(name, os.path.isdir(os.path.join(path, name))) for name in os.listdir(path)]
+    result = []
+    for entry in scandir(path):
+        try:
+            result.append((entry.name, entry.is_dir()))
+        except OSError:
+            pass  # removed meanwhile
+    return result
+
+
+def etag(st):
+    return '"%x-%x-%x"' % (st.st_ino, st.st_size, int(st.st_mtime * 1000000))
+
+
+def parse_range(header, size):
+    '''(start, end) of a single "bytes=" range, end excluded; None when the header is not one we serve partially.'''
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    start, sep, end = header[len('bytes='):].strip().partition('-')
+    try:
+        if not start:
+            start, end = max(size - int(end), 0), size
+        else:
+            start, end = int(start), min(int(end) + 1, size) if end else size
+    except ValueError:
+        return None
+    if start >= size or start >= end:
+        abort(416, 'Requested range not satisfiable.')
+    return start, end
+
+
+def serve(filename):
+    '''the plain or chunkstore file filename, honouring conditional and range requests.'''
+    chunked = not os.path.exists(filename) and chunkstore.is_chunked(filename)
+    if not chunked and not os.path.isfile(filename):
+        abort(404, 'File does not exist.')
+    if not os.access(chunkstore.watch_path(filename) if chunked else filename, os.R_OK):
+        abort(403, 'You do not have permission to access this file.')
+    st = os.stat(chunkstore.watch_path(filename) if chunked else filename)
+    reader = chunkstore.open_reader(filename) if chunked else None
+    size = reader.size() if chunked else st.st_size
+    tag, last_modified = etag(st), formatdate(st.st_mtime, usegmt=True)
+
+    mimetype, encoding = mimetypes.guess_type(filename)
+    if encoding:
+        mimetype = 'application/octet-stream'  # served as stored, ranges are ranges of the compressed bytes
+    response.content_type = mimetype or 'text/plain'
+    if response.content_type.startswith('text/'):
+        response.content_type += '; charset=UTF-8'
+    response.set_header('ETag', tag)
+    response.set_header('Last-Modified', last_modified)
+    response.set_header('Accept-Ranges', 'bytes')
+    if tag in [t.strip() for t in request.get_header('If-None-Match', '').split(',')] or \
+            not_modified_since(request.get_header('If-Modified-Since'), st.st_mtime):
+        response.status = 304
+        return ''
+
+    if_range = request.get_header('If-Range')
+    byte_range = parse_range(request.get_header('Range'), size) if if_range in (None, tag, last_modified) else None
+    start, end = byte_range or (0, size)
+    if byte_range:
+        response.status = 206
+        response.set_header('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, size))
+    response.content_length = end - start
+    if request.method == 'HEAD':
+        return ''
+    if chunked:
+        return read_blocks(reader.read, start, end)
+    f = open(filename, 'rb')
+    f.seek(start)
+    if end == st.st_size:
+        return f  # bottle hands it to wsgi.file_wrapper: sendfile from the current position, bounded by Content-Length
+    return read_blocks(lambda offset, size: f.read(size), start, end, f)
+
+
+def not_modified_since(header, mtime):
+    date = parsedate(header.split(';')[0].strip()) if header else None
+    return date is not None and int(mtime) <= calendar.timegm(date)
+
+
+def read_blocks(read, start, end, f=None):
+    try:
+        while start < end:
+            data = read(start, min(block_size, end - start))
+            if not data:
+                break
+            start += len(data)
+            yield data
+    finally:
+        if f is not None:
+            f.close()
+
+
+def listing(path, limit=None, cursor=None, recursive=False, sizes=False):
+    '''{"files": [...]} of a directory in name order, paged by limit and the next_cursor of the previous page.
+
+    In recursive mode the whole tree is listed by relative paths, parents first. The tree is
+    walked lazily from the cursor on and the walk stops once the page is full. With sizes the
+    size of a directory is the total size of everything under it, which stats its whole tree.'''
+    names = list(itertools.islice(walk(path, cursor.split('/') if cursor else [], recursive), limit + 1 if limit else None))
+    page = names[:limit] if limit else names
+    result = {'files': [item for item in (describe(path, name, is_dir) for name, is_dir in page) if item]}
+    if limit and len(names) > limit:
+        result['next_cursor'] = page[-1][0]
+    if sizes:
+        for item in result['files']:
+            if item['is_dir']:
+                item['size'] = subtree_size(os.path.join(path, item['name']))
+    return result
+
+
+def walk(path, cursor, recursive, prefix=''):
+    '''yield (relative path, is_dir) of what comes after the cursor components, a directory right before its content.
+
+    That is the order of the paths compared component by component, so the directories
+    sorted before the cursor are skipped without being read.'''
+    depth = prefix.count('/')
+    for name, is_dir in sorted(entries(os.path.join(path, prefix) if prefix else path)):
+        if cursor and name < cursor[depth]:
+            continue
+        on_cursor = bool(cursor) and name == cursor[depth]
+        if not on_cursor:
+            yield prefix + name, is_dir
+        if is_dir and recursive:
+            # under the cursor itself everything comes after it, under one of its parents only what follows it
+            below = cursor if on_cursor and len(cursor) > depth + 1 else []
+            for item in walk(path, below, recursive, prefix + name + '/'):
+                yield item
+        cursor = []  # the next names all come after it
+
+
+def subtree_size(path):
+    '''the total size of the files under path.'''
+    total = 0
+    for name, is_dir in entries(path):
+        if is_dir:
+            total += subtree_size(os.path.join(path, name))
+            continue
+        try:
+            total += os.lstat(os.path.join(path, name)).st_size
+        except OSError:
+            pass
+    return total
+
+
+def describe(path, name, is_dir):
+    '''the listing item of name, chunkstore files under their logical name; None for the index of a chunkstore file.'''
+    if name.endswith('.gz.idx') and os.path.exists(os.path.join(path, name[:-len('.idx')])):
+        return None  # listed with its chunkstore data
+    filename = os.path.join(path, name)
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    item = {
+        'name': name,
+        'is_dir': is_dir,
+        'create_time': stat.st_ctime,
+        'modify_time': stat.st_mtime,
+        'size': stat.st_size
+    }
+    if name.endswith('.gz') and os.path.exists(filename + '.idx'):  # a chunkstore file is listed by its logical name and size
+        item.update({'name': name[:-len('.gz')], 'size': chunkstore.open_reader(filename[:-len('.gz')]).size(), 'compressed_size': stat.st_size})
+    return item
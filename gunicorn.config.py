@@ -3,7 +3,6 @@
 
 import os
 import signal
-import sys
 
 # Sample Gunicorn configuration file.
 
@@ -76,7 +75,7 @@ backlog = 32
 #       A positive integer. Generally set in the 1-5 seconds range.
 #
 
-workers = 1
+workers = int(os.environ.get('WORKERS', 1))  # several workers share the job state through jobstore
 worker_class = 'egg:gunicorn#gevent'
 worker_connections = 32
 timeout = 60
@@ -101,6 +100,16 @@ keepalive = 2
 debug = False
 spew = False
 
+#
+#   reload_on_change - Restart the workers when a source file of the
+#       project changes, from RELOAD=1 in the environment. For
+#       development: nothing is watched when it is off.
+#
+#       True or False
+#
+
+reload_on_change = os.environ.get('RELOAD', '0') not in ['0', 'false', 'False', '']
+
 #
 # Server mechanics
 #
@@ -203,39 +212,19 @@ def pre_exec(server):
 def on_starting(server):
     from gevent import monkey
     monkey.patch_socket()
+    os.environ['WORKERS'] = str(server.num_workers)  # however they were given, for jobs.shared in the workers
 
 
 def when_ready(server):
-    import gevent
-
     server.log.info("Server is ready. Spwawning workers")
-    server.num_workers = 1  # make sure only one worker forked
-
-    def file_change_monitor():
-        server.log.info("Starting to monitor file changes of worker app...")
-        modify_times = {}
-        while True:
-            for module in sys.modules.values():
-                path = getattr(module, "__file__", None)
-                if not path:
-                    continue
-                if path.endswith(".pyc") or path.endswith(".pyo"):
-                    path = path[:-1]
-                try:
-                    modified = os.stat(path).st_mtime
-                except:
-                    continue
-                if path not in modify_times:
-                    modify_times[path] = modified
-                    continue
-                if modify_times[path] != modified:
-                    server.log.info("%s modified; restarting server", path)
-                    os.kill(os.getpid(), signal.SIGHUP)
-                    modify_times = {}
-                    break
-            gevent.sleep(1)
-
-    gevent.spawn(file_change_monitor)
+    if reload_on_change:
+        import reloader
+
+        def changed(paths):
+            server.log.info("%s modified; restarting server", ', '.join(paths))
+            os.kill(os.getpid(), signal.SIGHUP)
+        reloader.start(changed, log=server.log)
+        server.log.info("Watching the code for changes...")
 
 
 def on_reload(server):
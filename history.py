@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import sqlite3
+import threading
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    serial TEXT,
+    repo_url TEXT,
+    started_at REAL,
+    finished_at REAL,
+    exit_code INTEGER,
+    info TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_started ON jobs (started_at, job_id);
+CREATE INDEX IF NOT EXISTS jobs_serial ON jobs (serial, started_at);
+CREATE INDEX IF NOT EXISTS jobs_repo ON jobs (repo_url, started_at);
+'''
+
+
+class JobHistory(object):
+    '''an sqlite index of the job.json files under the jobs path, kept up to date by jobs.write_json.
+
+    The job.json files stay the source of truth: the index is rebuilt from them
+    whenever the database file is missing.'''
+
+    def __init__(self, jobs_path, filename='.history.db'):
+        self.jobs_path = jobs_path
+        self.db = os.path.join(jobs_path, filename)
+        self._ready = False
+        self._lock = threading.Lock()
+
+    def connect(self):
+        self.ensure()
+        return self._connect()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def ensure(self):
+        with self._lock:
+            if self._ready:
+                return
+            if not os.path.isdir(self.jobs_path):
+                os.makedirs(self.jobs_path)
+            missing = not os.path.exists(self.db)
+            conn = self._connect()
+            try:
+                conn.executescript(SCHEMA)
+                if missing:
+                    self._rebuild(conn)
+                conn.commit()
+            finally:
+                conn.close()
+            self._ready = True
+
+    def _rebuild(self, conn):
+        for dirname in os.listdir(self.jobs_path):
+            json_file = os.path.join(self.jobs_path, dirname, 'job.json')
+            if os.path.isfile(json_file):
+                try:
+                    with open(json_file) as f:
+                        conn.execute(*_upsert(json.load(f)))
+                except ValueError:
+                    pass  # a job.json being written right now, it gets indexed when done.
+
+    def index(self, info):
+        conn = self.connect()
+        try:
+            conn.execute(*_upsert(info))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def remove(self, job_id):
+        conn = self.connect()
+        try:
+            conn.execute('DELETE FROM jobs WHERE job_id = ?', (job_id,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def query(self, limit=None, cursor=None, reverse=False, serial=None, repo=None, exit_code=None, since=None, until=None):
+        '''one page of jobs sorted by started_at, and the cursor of the next page (None on the last page).'''
+        where, args = [], []
+        for column, value in [('serial', serial), ('repo_url', repo), ('exit_code', exit_code)]:
+            if value is not None:
+                where.append('%s = ?' % column)
+                args.append(value)
+        if since is not None:
+            where.append('started_at >= ?')
+            args.append(float(since))
+        if until is not None:
+            where.append('started_at < ?')
+            args.append(float(until))
+        if cursor:
+            started_at, job_id = cursor.split(',', 1)
+            where.append('(started_at %s ? OR (started_at = ? AND job_id %s ?))' % (('<', '<') if reverse else ('>', '>')))
+            args.extend([float(started_at), float(started_at), job_id])
+        order = 'DESC' if reverse else 'ASC'
+        sql = 'SELECT started_at, job_id, info FROM jobs %s ORDER BY started_at %s, job_id %s' % (
+            'WHERE ' + ' AND '.join(where) if where else '', order, order)
+        if limit is not None:
+            sql += ' LIMIT %d' % (int(limit) + 1)
+        conn = self.connect()
+        try:
+            rows = conn.execute(sql, args).fetchall()
+        finally:
+            conn.close()
+        next_cursor = None
+        if limit is not None and len(rows) > int(limit):
+            rows = rows[:int(limit)]
+            next_cursor = '%r,%s' % (rows[-1][0], rows[-1][1])
+        return [json.loads(row[2]) for row in rows], next_cursor
+
+
+def _upsert(info):
+    return ('INSERT OR REPLACE INTO jobs (job_id, serial, repo_url, started_at, finished_at, exit_code, info) VALUES (?, ?, ?, ?, ?, ?, ?)', (
+        info['job_id'],
+        info.get('env', {}).get('ANDROID_SERIAL'),
+        (info.get('repo') or {}).get('url'),
+        float(info['started_at']),
+        float(info['finished_at']) if 'finished_at' in info else None,
+        info.get('exit_code'),
+        json.dumps(info, sort_keys=True)
+    ))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''A minimal ctypes binding of linux inotify; available() is False anywhere else.'''
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import select
+import struct
+
+import native
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+
+_event = struct.Struct('iIII')
+_libc = None
+
+
+def _load():
+    global _libc
+    if _libc is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            libc.inotify_init, libc.inotify_add_watch, libc.inotify_rm_watch
+            _libc = libc
+        except (OSError, AttributeError):
+            _libc = False
+    return _libc
+
+
+def available():
+    return bool(_load())
+
+
+class Inotify(object):
+
+    def __init__(self):
+        libc = _load()
+        if not libc:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        fcntl.fcntl(self.fd, fcntl.F_SETFL, fcntl.fcntl(self.fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        fcntl.fcntl(self.fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        self._poll = None  # None to wait in select.select: under gevent, the cooperative one
+        if hasattr(select, 'poll') and not native.green():
+            self._poll = select.poll()
+            self._poll.register(self.fd, select.POLLIN)
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        wd = _libc.inotify_add_watch(self.fd, path.encode('utf-8') if not isinstance(path, bytes) else path, mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed', path)
+        return wd
+
+    def rm_watch(self, wd):
+        _libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        '''wait up to timeout seconds (forever with None) and return the [(wd, mask, name)] events.'''
+        if self._poll is not None:
+            ready = self._poll.poll(None if timeout is None else int(timeout * 1000))
+        else:
+            ready = select.select([self.fd], [], [], timeout)[0]
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        events, pos = [], 0
+        while pos + _event.size <= len(data):
+            wd, mask, cookie, length = _event.unpack_from(data, pos)
+            pos += _event.size
+            events.append((wd, mask, data[pos:pos + length].rstrip(b'\0').decode('utf-8', 'replace')))
+            pos += length
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
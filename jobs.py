@@ -1,63 +1,152 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from bottle import Bottle, request, template, abort, static_file
+from bottle import Bottle, request, response, template, abort, static_file
 import os
 import uuid
-import sh
 import json
 import yaml
 from datetime import datetime
 import time
 import threading
-import functools
 import psutil
 import shutil
+import subprocess
+import sys
 import adb
+import archive
+import chunkstore
+import devices
+import events
+import files
+import history
+import jobstore
+import metrics
+import mirrors
+import paths
+import reaper
+import scheduler
+import screen
+import stats
+import tail
+import venvs
 
 app = Bottle()
 app.config.setdefault('jobs.path', '/home/pi/jobs')
 app.config.setdefault('jobs.init_script', '.init.yml')
-
-jobs = []  # we are using memory obj, so we MUST get ONE app instance running.
-
-_lock = threading.Lock()
-
-
-def lock(fn):
-    global _lock
-
-    @functools.wraps(fn)
-    def wrapper(*args, **kwargs):
-        _lock.acquire()
-        try:
-            return fn(*args, **kwargs)
-        except:
-            raise
-        finally:
-            _lock.release()
-    return wrapper
+app.config.setdefault('jobs.output_storage', 'plain')  # or "chunked": compressed and indexed by chunkstore
+app.config.setdefault('jobs.venv_cache', '/home/pi/venvs')  # prebuilt init script virtualenvs, empty to disable
+app.config.setdefault('jobs.venv_cache_budget', 4 << 30)  # bytes
+app.config.setdefault('jobs.output_grace', 5)  # seconds the chunked output writers get to drain once the job exited
+app.config.setdefault('jobs.max_running', 0)  # jobs running at the same time on this workstation, 0 for no limit
+app.config.setdefault('jobs.adopt_interval', 5)  # seconds between two looks for the jobs of dead workers, with several workers
+
+shared = int(os.environ.get('WORKERS', 1)) > 1  # the gunicorn workers share the running jobs and the queue, see jobstore
+
+
+
+class JobRegistry(object):
+    '''the running jobs, indexed by job_id.
+
+    The registry lock only guards the indexes and is held for a few dict operations;
+    anything slow (rmtree, spawning, job.json, callbacks) runs outside of it, under the
+    job's own lock when it must not race with another operation on the same job.'''
+
+    def __init__(self):
+        self._lock = metrics.TimedLock('jobs.registry')
+        self._by_id = {}
+        self._exclusive = {}  # serial -> job_id of the exclusive job holding the device
+
+    def add(self, job):
+        '''register the job, or return why it conflicts with a running one.'''
+        info = job['job_info']
+        job_id, serial = info['job_id'], info['env']['ANDROID_SERIAL']
+        with self._lock:
+            if job_id in self._by_id:
+                return 'A job with the same job_id is running! If you want to re-run the job, please stop the running one firestly.'
+            if info['exclusive'] and serial in self._exclusive:
+                return 'A job on device with the same ANDROID_SERIAL is running!'
+            self._by_id[job_id] = job
+            if info['exclusive']:
+                self._exclusive[serial] = job_id
+
+    def remove(self, job):
+        info = job['job_info']
+        job_id, serial = info['job_id'], info['env']['ANDROID_SERIAL']
+        with self._lock:
+            if self._by_id.get(job_id) is not job:
+                return
+            del self._by_id[job_id]
+            if self._exclusive.get(serial) == job_id:
+                del self._exclusive[serial]
+
+    def update(self, job):
+        pass  # the registry holds the job itself
+
+    def get(self, job_id):
+        with self._lock:
+            return self._by_id.get(job_id)
+
+    def is_free(self, serial, exclusive=True):
+        '''whether a job could start on the device now.'''
+        with self._lock:
+            return not exclusive or serial not in self._exclusive
+
+    def __len__(self):
+        with self._lock:
+            return len(self._by_id)
+
+    def all(self):
+        with self._lock:
+            return list(self._by_id.values())
+
+
+if shared:
+    store = jobstore.Store(lambda: app.config.get('jobs.path'))
+    registry, job_queue = jobstore.Registry(store), jobstore.Queue(store)
+    events.relay = jobstore.EventRelay(store)
+    stats.share, screen.share = jobstore.StatShare(store), jobstore.ScreenShare(store)
+else:
+    registry, job_queue = JobRegistry(), scheduler.JobQueue()
+
+metrics.gauge('jobs_running', 'Jobs running on the workstation.', fn=lambda: len(registry))
+metrics.gauge('jobs_queued', 'Jobs waiting for their device or a slot.', fn=lambda: len(job_queue))
+job_runtime = metrics.histogram('job_duration_seconds', 'Job run times, by exit status.', ['result'],
+                                (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400))
+callback_latency = metrics.histogram('job_callback_duration_seconds', 'Time from a job finishing to its callback being delivered.', ['result'])
+
+_histories = {}
+
+
+def job_history():
+    jobs_path = os.path.abspath(app.config.get('jobs.path'))
+    if jobs_path not in _histories:
+        _histories[jobs_path] = history.JobHistory(jobs_path)
+    return _histories[jobs_path]
 
 
 @app.get("/")
-@lock
 def all_jobs():
-    global jobs
-    job_path = app.config.get('jobs.path')
     reverse = get_boolean(request.params.get('reverse', 'false'))
     all = get_boolean(request.params.get('all', 'false'))
     result = {}
     if all:
-        result['all'] = []
-        for dirname in os.listdir(job_path):
-            json_file = os.path.join(job_path, dirname, 'job.json')
-            if os.path.isfile(json_file):
-                with open(json_file) as f:
-                    result['all'].append(json.load(f))
-    result['jobs'] = [job['job_info'] for job in jobs]
-
-    for key in result:  # sort
-        result[key] = sorted(result[key], key=lambda x: float(x['started_at']), reverse=reverse)
+        params = request.params
+        with metrics.timer(metrics.disk_io, ('history.query',)):
+            result['all'], next_cursor = job_history().query(
+                limit=number('limit', params.get('limit')),
+                cursor=params.get('cursor'),
+                reverse=reverse,
+                serial=params.get('serial'),
+                repo=params.get('repo'),
+                exit_code=number('exit_code', params.get('exit_code')),
+                since=number('since', params.get('since'), float),
+                until=number('until', params.get('until'), float)
+            )
+        if next_cursor:
+            result['next_cursor'] = next_cursor
+    result['jobs'] = sorted([job['job_info'] for job in registry.all()], key=lambda x: float(x['started_at']), reverse=reverse)
+    result['queued'] = [queued_info(spec, i) for i, spec in enumerate(job_queue.ordered())]
 
     return result
 
@@ -73,94 +162,320 @@ def create_job_with_id(job_id):
     return create_job(job_id, refine_url(request.url))
 
 
-@lock
 def create_job(job_id, job_url):
     repo = request.json.get('repo')
     if repo is None:
         abort(400, 'The "repo" is mandatory for creating a new job!')
-    exclusive = get_boolean(request.json.get('exclusive', True))
     env = request.json.get('env', {})
-    env.setdefault('ANDROID_SERIAL', 'no_device')
-
-    global jobs
-    if exclusive and any(job['job_info']['env']['ANDROID_SERIAL'] == env['ANDROID_SERIAL'] and job['job_info']['exclusive'] for job in jobs):
-        abort(409, 'A job on device with the same ANDROID_SERIAL is running!')
-
-    if env['ANDROID_SERIAL'] not in adb.devices(status='ok') and env['ANDROID_SERIAL'] != 'no_device':
-        abort(404, 'No specified device attached!')
-
-    if any(job['job_info']['job_id'] == job_id for job in jobs):
-        abort(409, 'A job with the same job_id is running! If you want to re-run the job, please stop the running one firestly.')
-
-    job_path = os.path.abspath(os.path.join(app.config.get('jobs.path'), job_id))
-    shutil.rmtree(job_path, ignore_errors=True)
-    workspace = os.path.join(job_path, 'workspace')
-    os.makedirs(workspace)  # make the working directory for the job
-    env.update({
-        'WORKSPACE': workspace,
-        'JOB_ID': job_id
-    })
-    filenames = ['repo', 'output', 'error', 'run.sh', 'job.json']
-    local_repo, job_out, job_err, job_script, job_info = [os.path.join(job_path, f) for f in filenames]
-    with open(job_script, "w") as script_f:
-        script_f.write(template(
-            'run_script',
-            repo=repo,
-            local_repo=local_repo,
-            init_script='%s/init_script/%s' % (
-                job_url,
-                repo.get('init_script', request.app.config.get('jobs.init_script'))
-            ),
-            env=env
-        ))
-    proc = sh.bash(job_script, _out=job_out, _err=job_err, _bg=True)
+    selector = request.json.get('device')  # {"ro.product.model": ...}: run on any idle device matching these props
+    if not selector:
+        env.setdefault('ANDROID_SERIAL', 'no_device')
+        if env['ANDROID_SERIAL'] not in adb.devices(status='ok') and env['ANDROID_SERIAL'] != 'no_device':
+            abort(404, 'No specified device attached!')
 
     timestamp = time.time()
-    result = {
-        'repo': repo,
+    spec = {
         'job_id': job_id,
-        'job_pid': proc.pid,
-        'job_path': job_path,
+        'job_url': job_url,
+        'repo': repo,
         'env': env,
-        'exclusive': exclusive,
+        'exclusive': get_boolean(request.json.get('exclusive', True)),
+        'device': selector,
+        'priority': number('priority', request.json.get('priority', 0)),
+        'callback': request.json.get('callback'),
+        'init_script': repo.get('init_script', request.app.config.get('jobs.init_script')),
+        'queued_at': str(timestamp),
+        'queued_datetime': str(datetime.fromtimestamp(timestamp))
+    }
+    if registry.get(job_id) is not None or not job_queue.push(spec):
+        abort(409, 'A job with the same job_id is running! If you want to re-run the job, please stop the running one firestly.')
+    dispatch()
+    if 'result' in spec:
+        return spec['result']
+    elif 'error' in spec:
+        abort(500, spec['error'])
+    if not get_boolean(request.json.get('queue', True)):
+        job_queue.remove(job_id)
+        abort(409, not_started_reason(spec))
+    response.status = 202
+    return queued_info(spec)
+
+
+def not_started_reason(spec):
+    '''why dispatch() did not start the job right away.'''
+    max_running = int(app.config.get('jobs.max_running'))
+    if max_running and len(registry) >= max_running:
+        return 'The limit of %d running jobs is reached!' % max_running
+    if not spec['device']:
+        return 'A job on device with the same ANDROID_SERIAL is running!'
+    serials = sorted(adb.devices(status='ok'))
+    props = devices.static_props(serials)
+    if not any(scheduler.matches(props[se], spec['device']) for se in serials):
+        return 'No attached device matches the specified "device"!'
+    return 'All the devices matching the specified "device" are running jobs!'
+
+
+def queued_info(spec, position=None):
+    info = dict((k, v) for k, v in spec.items() if k not in ['job_url', 'callback', 'init_script', 'error', 'result'])
+    info['position'] = job_queue.position(spec['job_id']) if position is None else position
+    return info
+
+
+_dispatch_lock = metrics.TimedLock('jobs.dispatch', jobstore.FileLock(lambda: store.path('.dispatch.lock')) if shared else None)
+
+
+def dispatch():
+    '''start the queued jobs that can run now, in priority order.'''
+    with _dispatch_lock:
+        max_running = int(app.config.get('jobs.max_running'))
+        for spec in job_queue.ordered():
+            if max_running and len(registry) >= max_running:
+                break
+            serial = place(spec)
+            if serial is None:
+                continue
+            if job_queue.remove(spec['job_id']) is None:
+                continue  # stopped meanwhile
+            try:
+                spec['result'] = start_job(spec, serial)
+            except Exception as e:
+                spec['error'] = str(e)
+                fail_job(spec, serial, str(e))
+
+
+def dispatch_later():
+    if len(job_queue):
+        threading.Thread(target=dispatch).start()
+
+
+adb.tracker.subscribe(lambda event: event['status'] == 'device' and dispatch_later())
+
+
+def place(spec):
+    '''the serial the queued job can start on right now, or None.'''
+    if not spec['device']:
+        serial = spec['env']['ANDROID_SERIAL']
+        if serial != 'no_device' and serial not in adb.devices(status='ok'):
+            return None  # detached since it got queued
+        return serial if registry.is_free(serial, spec['exclusive']) else None
+    idle = [se for se in sorted(adb.devices(status='ok')) if registry.is_free(se, spec['exclusive'])]
+    props = devices.static_props(idle)
+    for se in idle:
+        if scheduler.matches(props[se], spec['device']):
+            return se
+    return None
+
+
+def new_job_info(spec, serial):
+    timestamp = time.time()
+    return {
+        'repo': spec['repo'],
+        'job_id': spec['job_id'],
+        'job_path': os.path.abspath(os.path.join(app.config.get('jobs.path'), spec['job_id'])),
+        'env': dict(spec['env'], ANDROID_SERIAL=serial),
+        'exclusive': spec['exclusive'],
         'started_at': str(timestamp),
         'started_datetime': str(datetime.fromtimestamp(timestamp))
     }
-    job = {'proc': proc, 'job_info': result}
-    jobs.append(job)
-
-    callback = request.json.get('callback')
-    def proc_clear():
-        @lock
-        def check():
-            global jobs
-            if job and job['proc'].process.alive:
-                return True
-            else:
-                jobs.remove(job)
-                try:
-                    result['exit_code'] = job['proc'].exit_code  # catch the exception while touching the exit_code first time.
-                except:
-                    result['exit_code'] = job['proc'].exit_code
-                finally:
-                    timestamp = time.time()
-                    result['finished_at'] = str(timestamp)
-                    result['finished_datetime'] = str(datetime.fromtimestamp(timestamp))
-                write_json(job_info, result)
-                if callback:
-                    import requests
-                    try:
-                        requests.get(callback, params={'job_id': job_id})
-                    except:
-                        pass
-                return False
-        while check():
-            time.sleep(1)
-    threading.Thread(target=proc_clear).start()
-    write_json(job_info, result)
+
+
+def start_job(spec, serial):
+    result = new_job_info(spec, serial)
+    job_id, repo, env, job_path = result['job_id'], result['repo'], result['env'], result['job_path']
+    job = {'job_info': result, 'lock': threading.Lock(), 'callback': spec['callback']}
+    conflict = registry.add(job)  # claims the job_id and the device before doing anything slow.
+    if conflict:
+        raise RuntimeError(conflict)
+
+    try:
+        with job['lock']:
+            workspace = os.path.join(job_path, 'workspace')
+            with metrics.timer(metrics.disk_io, ('workspace',)):
+                shutil.rmtree(job_path, ignore_errors=True)
+                os.makedirs(workspace)  # make the working directory for the job
+            env.update({
+                'WORKSPACE': workspace,
+                'JOB_ID': job_id
+            })
+            filenames = ['repo', 'output', 'error', 'run.sh', 'job.json', 'exit_code']
+            local_repo, job_out, job_err, job_script, job_info, job_rc = [os.path.join(job_path, f) for f in filenames]
+            with open(job_script, "w") as script_f:
+                script_f.write(template(
+                    'run_script',
+                    repo=repo,
+                    local_repo=local_repo,
+                    init_script='%s/init_script/%s' % (spec['job_url'], spec['init_script']),
+                    mirror=mirror_command('prepare'),
+                    mirror_maintenance=mirror_command('maintain'),
+                    env=env
+                ))
+            job['proc'], writers = spawn_job(job_script, job_out, job_err, job_rc)
+            result['job_pid'] = job['proc'].pid
+            write_json(job_info, result)
+            registry.update(job)
+    except:
+        registry.remove(job)
+        raise
+    events.publish('job.started', dict(result))
+
+    remaining, remaining_lock = [job['proc']] + writers, threading.Lock()
+
+    def exited(proc):
+        with remaining_lock:
+            remaining.remove(proc)
+            done = not remaining
+        if done:  # the output is complete only once the writers are gone too.
+            returncode = job['proc'].returncode
+            if returncode is None:  # its status got lost, what the wrapper wrote if anything
+                returncode = read_exit_code(os.path.join(job_path, 'exit_code'))
+            finish_job(job, returncode, spec['callback'])
+        elif proc is job['proc']:  # a process left behind by the job may hold the writers' pipes open
+            threading.Thread(target=stop_writers, args=(writers, float(app.config.get('jobs.output_grace')))).start()
+    for proc in list(remaining):
+        reaper.watch(proc, lambda returncode, proc=proc: exited(proc))
     return result
 
 
+def mirror_command(action):
+    '''the command running `mirrors.py action` with the configured settings, None when mirrors are disabled.
+
+    "prepare" prints the path of the shared mirror of a repo url, "maintain" collects and evicts the mirrors.'''
+    config = mirrors.app.config
+    if not get_boolean(config.get('mirrors.enabled')):
+        return None
+    options = {
+        'prepare': '--refresh %s' % config.get('mirrors.refresh_interval'),
+        'maintain': '--gc-interval %s --max-age %s' % (config.get('mirrors.gc_interval'), config.get('mirrors.max_age'))
+    }[action]
+    return '%s %s %s --root %s %s' % (sys.executable, paths.script_path(mirrors.__file__), action, config.get('mirrors.path'), options)
+
+
+def spawn_job(job_script, job_out, job_err, job_rc):
+    '''start the job script; returns the job process and the chunkstore writers of its output, if any.
+
+    The script runs under a wrapper writing its exit code to job_rc, for whoever adopts
+    the job when the worker waiting for it is gone.'''
+    command = ['bash', '-c', 'bash "$0"; rc=$?; echo $rc > "$1"; exit $rc', job_script, job_rc]
+    if app.config.get('jobs.output_storage') == 'chunked':
+        for f in (job_out, job_err):
+            chunkstore.create(f)
+        writers = [subprocess.Popen(chunkstore.writer_command(f), stdin=subprocess.PIPE, close_fds=True) for f in (job_out, job_err)]
+        try:
+            proc = subprocess.Popen(command, stdout=writers[0].stdin, stderr=writers[1].stdin, close_fds=True)
+        finally:
+            for writer in writers:
+                writer.stdin.close()
+        return proc, writers
+    with open(job_out, 'w') as out_f:
+        with open(job_err, 'w') as err_f:
+            return subprocess.Popen(command, stdout=out_f, stderr=err_f, close_fds=True), []
+
+
+def stop_writers(writers, grace):
+    '''give the chunkstore writers of a job that exited grace seconds to drain its output, then
+    terminate them (they write out what they buffered), and kill those still there after as long.'''
+    for stop in ('terminate', 'kill'):
+        deadline = time.time() + grace
+        while time.time() < deadline and any(writer.returncode is None for writer in writers):
+            time.sleep(0.1)
+        for writer in writers:
+            if writer.returncode is None:
+                try:
+                    getattr(writer, stop)()
+                except OSError:
+                    pass  # exited meanwhile
+
+
+def fail_job(spec, serial, error):
+    '''record a job that could not start as finished without an exit code, for whoever queued it.'''
+    if registry.get(spec['job_id']) is not None:
+        return  # the job_id is running, its files are not ours to touch
+    result = new_job_info(spec, serial)
+    result.update({
+        'exit_code': None,
+        'error': error,
+        'finished_at': result['started_at'],
+        'finished_datetime': result['started_datetime']
+    })
+    try:
+        if not os.path.isdir(result['job_path']):
+            os.makedirs(result['job_path'])
+        write_json(os.path.join(result['job_path'], 'job.json'), result)
+    except (IOError, OSError):
+        pass  # the disk is what failed, the event and the callback may still get through
+    events.publish('job.finished', dict(result))
+    if spec['callback']:
+        threading.Thread(target=notify, args=(spec['callback'], spec['job_id'], time.time())).start()
+
+
+def finish_job(job, returncode, callback=None):
+    '''called by the reaper as soon as the job process exits.'''
+    result = job['job_info']
+    with job['lock']:
+        result['exit_code'] = returncode
+        timestamp = time.time()
+        result['finished_at'] = str(timestamp)
+        result['finished_datetime'] = str(datetime.fromtimestamp(timestamp))
+        write_json(os.path.join(result['job_path'], 'job.json'), result)
+    registry.remove(job)
+    events.publish('job.finished', dict(result))
+    job_runtime.observe(timestamp - float(result['started_at']), ('success' if returncode == 0 else 'failure',))
+    dispatch_later()  # the device, or a slot on the workstation, just got free
+    if callback:
+        threading.Thread(target=notify, args=(callback, result['job_id'], timestamp)).start()
+
+
+def adopt_orphans():
+    '''take over the running jobs of the workers that are gone.'''
+    for job_id, owner in registry.orphans():
+        job = registry.adopt(job_id, owner)
+        if job is None:
+            continue  # adopted by another worker
+        info = job['job_info']
+
+        def finish(job=job, info=info):
+            finish_job(job, read_exit_code(os.path.join(info['job_path'], 'exit_code')), job.get('callback'))
+        if info.get('job_pid') and jobstore.running(info['job_pid'], info['job_path']):
+            reaper.watch_pid(info['job_pid'], finish)
+        else:
+            finish()
+
+
+def adopt_orphans_forever():
+    while True:
+        try:
+            adopt_orphans()
+        except Exception:
+            pass
+        time.sleep(float(app.config.get('jobs.adopt_interval')))
+
+
+if shared:
+    adopter = threading.Thread(target=adopt_orphans_forever, name='job-adopter')
+    adopter.daemon = True
+    adopter.start()
+
+
+def read_exit_code(filename):
+    '''the exit code the job wrapper wrote, None if it got killed before writing it.'''
+    try:
+        with open(filename) as f:
+            return int(f.read().strip())
+    except (IOError, ValueError):
+        return None
+
+
+def notify(callback, job_id, finished_at=None):
+    import requests
+    status = 'delivered'
+    try:
+        requests.get(callback, params={'job_id': job_id})
+    except:
+        status = 'failed'
+    if finished_at is not None:
+        callback_latency.observe(time.time() - finished_at, (status,))
+
+
 @app.get("/<job_id>/init_script/<script_name>")
 def init_script(job_id, script_name):
     return get_init_script(job_id, script_name)
@@ -172,23 +487,40 @@ def default_init_script(job_id):
 
 
 def get_init_script(job_id, script_name):
-    init_script = os.path.abspath(os.path.join(app.config.get('jobs.path'), job_id, 'repo', script_name))
-    with open(init_script, 'r') as f:
+    local_repo = os.path.abspath(os.path.join(app.config.get('jobs.path'), job_id, 'repo'))
+    with open(os.path.join(local_repo, script_name), 'r') as f:
         init_json = yaml.load(f.read())
-    return template('init_script', init=init_json)
+    return template('init_script', init=init_json, venv=venv_cache(init_json, local_repo))
+
+
+def venv_cache(init, local_repo):
+    '''where the init script finds (or builds) the virtualenv for its install list, None when the cache is disabled.'''
+    root = app.config.get('jobs.venv_cache')
+    if not root:
+        return None
+    installs = list(init.get('install', []))
+    cached = [install for install in installs if not venvs.local_install(install)]
+    return {
+        'root': root,
+        'path': os.path.join(root, venvs.cache_key(init.get('python', '2.7'), cached, local_repo)),
+        'installs': cached,
+        'local_installs': [install for install in installs if venvs.local_install(install)],
+        'evict': '%s %s evict --root %s --budget %d' % (sys.executable, paths.script_path(venvs.__file__), root, int(app.config.get('jobs.venv_cache_budget')))
+    }
 
 
 @app.delete("/<job_id>")
 @app.get("/<job_id>/stop")
-@lock
 def terminate_job(job_id):
-    global jobs
-    for job in jobs:
-        if job['job_info']['job_id'] == job_id:
-            kill_process_and_children(job['job_info']['job_pid'])
-            break
-    else:
+    if job_queue.remove(job_id) is not None:
+        return
+    job = registry.get(job_id)
+    if job is None:
         abort(410, 'The requested job is already dead!')
+    with job['lock']:
+        if 'exit_code' in job['job_info'] or 'job_pid' not in job['job_info']:
+            abort(410, 'The requested job is already dead!')
+        kill_process_and_children(job['job_info']['job_pid'])
 
 
 @app.get("/<job_id>")
@@ -200,28 +532,49 @@ def job_info(job_id):
 
 @app.get("/<job_id>/stream")
 def output(job_id):
-    lines = int(request.params.get('lines', 40))
+    '''follow the job output; resume with ?offset=<byte offset>, or Last-Event-ID with ?format=sse.'''
     jobs_path = app.config.get('jobs.path')
     job_path = os.path.abspath(os.path.join(jobs_path, job_id))
     job_out = os.path.join(job_path, 'output')
-    job_info = os.path.join(job_path, 'job.json')
-    if not os.path.exists(job_out) or not os.path.exists(job_info):
-        raise StopIteration
-    with open(job_info) as f:
-        info = json.load(f)
-    args = ['--lines=%d' % lines, job_out] if "exit_code" in info else ['--lines=%d' % lines, '--pid=%d' % info['job_pid'], '-f', job_out]
-    for line in sh.tail(*args, _iter=True):
-        yield line
+    if not chunkstore.exists(job_out) or not os.path.exists(os.path.join(job_path, 'job.json')):
+        return []
+    sse = request.params.get('format') == 'sse'
+    offset = number('offset', request.params.get('offset', request.get_header('Last-Event-ID') if sse else None))
+    if offset is None:
+        offset = tail.offset_of_last_lines(job_out, number('lines', request.params.get('lines', 40)))
+    chunks = tail.follow(job_out, max(offset, 0), lambda: registry.get(job_id) is not None)
+    response.set_header('X-Stream-Offset', str(max(offset, 0)))
+    if sse:
+        response.content_type = 'text/event-stream'
+        response.set_header('Cache-Control', 'no-cache')
+        return sse_events(chunks)
+    return (data for offset, data in chunks)
+
+
+def sse_events(chunks):
+    '''one event per batch of complete lines, with the byte offset after them as the event id.'''
+    partial, end = b'', 0
+    for offset, data in chunks:
+        data, end = partial + data, offset + len(data)
+        lines = data.split(b'\n')
+        partial = lines.pop()
+        if lines:
+            yield b''.join(b'data: ' + line + b'\n' for line in lines) + ('id: %d\n\n' % (end - len(partial))).encode('utf-8')
+    if partial:
+        yield b'data: ' + partial + ('\nid: %d\n\n' % end).encode('utf-8')
 
 
 @app.get("/<job_id>/files/<path:path>")
 def download_file(job_id, path):
+    '''a file of the job (Range and If-Range supported), or the listing of a directory.'''
     jobs_path = app.config.get('jobs.path')
     job_path = os.path.abspath(os.path.join(jobs_path, job_id))
-    if os.path.isdir(os.path.join(job_path, path)):
-        return {'files': list_dir(os.path.join(job_path, path))}
-    else:
-        return static_file(path, root=job_path)
+    filename = os.path.abspath(os.path.join(job_path, path))
+    if not filename.startswith(job_path + os.sep):
+        abort(403, 'Access denied.')
+    elif os.path.isdir(filename):
+        return list_dir(filename)
+    return files.serve(filename)
 
 
 @app.get("/<job_id>/files")
@@ -231,21 +584,37 @@ def list_files(job_id):
     job_path = os.path.abspath(os.path.join(jobs_path, job_id))
     if not os.path.exists(job_path):
         abort(404, 'Oh, no! The requested path does not exists!')
-    return {'files': list_dir(job_path)}
+    return list_dir(job_path)
+
+
+@app.get("/<job_id>/archive")
+def archive_files(job_id):
+    '''stream the job directory (or ?path= in it) as ?format=tar.gz|zip, filtered by any number of ?include= and ?exclude= globs.'''
+    jobs_path = app.config.get('jobs.path')
+    job_path = os.path.abspath(os.path.join(jobs_path, job_id))
+    root = os.path.abspath(os.path.join(job_path, request.params.get('path', '')))
+    if root != job_path and not root.startswith(job_path + os.sep) or not os.path.isdir(root):
+        abort(404, 'Oh, no! The requested path does not exists!')
+    format = request.params.get('format', 'tar.gz')
+    if format not in archive.formats:
+        abort(400, 'Unsupported archive format, should be one of %s.' % ', '.join(sorted(archive.formats)))
+    response.content_type = archive.formats[format]
+    response.set_header('Content-Disposition', 'attachment; filename="%s.%s"' % (os.path.basename(root), format))
+    return archive.stream(root, format, request.params.getall('include'), request.params.getall('exclude'))
 
 
 @app.delete("/<job_id>/files")
 @app.get("/<job_id>/remove_files")
-@lock
 def delete_file(job_id):
-    global jobs
     jobs_path = app.config.get('jobs.path')
     job_path = os.path.abspath(os.path.join(jobs_path, job_id))
-    if any(job_id == job['job_info']['job_id'] for job in jobs):
+    if registry.get(job_id) is not None or job_queue.get(job_id) is not None:
         abort(409, 'The specified job is running!')
     elif not os.path.exists(job_path):
         abort(400, 'No specified job!')
-    shutil.rmtree(job_path, ignore_errors=True)
+    with metrics.timer(metrics.disk_io, ('rmtree',)):
+        shutil.rmtree(job_path, ignore_errors=True)
+        job_history().remove(job_id)
 
 
 def refine_url(url):
@@ -273,24 +642,26 @@ def get_boolean(param):
     return param if isinstance(param, bool) else param not in ['false', '0', 0, 'False']
 
 
+def number(name, param, type=int):
+    '''param as a number, None when missing; a 400 when it is not a number.'''
+    if param is None:
+        return None
+    try:
+        return type(param)
+    except (TypeError, ValueError):
+        abort(400, 'The "%s" should be a number!' % name)
+
+
 def write_json(filename, obj):
-    with open(filename, 'w') as info_f:
-        info_f.write(json.dumps(obj, sort_keys=True, indent=2))
+    with metrics.timer(metrics.disk_io, ('job.json',)):
+        with open(filename, 'w') as info_f:
+            info_f.write(json.dumps(obj, sort_keys=True, indent=2))
+        job_history().index(obj)
 
 
 def list_dir(path):
-    if not os.path.exists(path) or not os.path.isdir(path):
-        return None
-
-    result = []
-    for f in os.listdir(path):
-        filename = os.path.join(path, f)
-        stat = os.stat(filename)
-        result.append({
-            'name': f,
-            'is_dir': os.path.isdir(filename),
-            'create_time': stat.st_ctime,
-            'modify_time': stat.st_mtime,
-            'size': stat.st_size
-        })
-    return result
+    '''the listing of path, paged by ?limit=&cursor=, of the whole tree with ?recursive=true, directory sizes with ?sizes=true.'''
+    limit = number('limit', request.params.get('limit', 0)) or None
+    with metrics.timer(metrics.disk_io, ('listing',)):
+        return files.listing(path, limit, request.params.get('cursor'), get_boolean(request.params.get('recursive', False)),
+                             get_boolean(request.params.get('sizes', False)))
@@ -0,0 +1,519 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Job state shared by the gunicorn workers of the server, when there are several.
+
+The running jobs, the job queue and the change events live in an sqlite database (WAL)
+under the jobs path, and every check-and-set is a BEGIN IMMEDIATE transaction, so two
+workers never both claim a job_id or a device. Dispatching is serialized by a file lock.
+
+A running job belongs to the worker that spawned it (its pid is the owner of the row).
+When that worker is gone, another one adopts the job: it waits for the job process with
+reaper.watch_pid and reads the exit code from the file the job wrapper writes.
+
+The work on the devices is done once for all the workers too: the stat samples are taken
+by one worker and shared in the database, and the screens are captured into files the
+other workers read.
+'''
+
+from contextlib import contextmanager
+import errno
+import fcntl
+import json
+import os
+import sqlite3
+import struct
+import threading
+import time
+
+import events
+import reaper
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS running (
+    job_id TEXT PRIMARY KEY,
+    serial TEXT,
+    exclusive INTEGER,
+    owner INTEGER,
+    callback TEXT,
+    info TEXT
+);
+CREATE INDEX IF NOT EXISTS running_serial ON running (serial, exclusive);
+CREATE TABLE IF NOT EXISTS queue (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT UNIQUE,
+    rank INTEGER,
+    spec TEXT
+);
+CREATE INDEX IF NOT EXISTS queue_order ON queue (rank, seq);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    type TEXT,
+    time REAL,
+    data TEXT
+);
+CREATE TABLE IF NOT EXISTS samples (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    serial TEXT,
+    time REAL,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS samples_serial ON samples (serial, time);
+'''
+
+
+class Store(object):
+    '''the shared database under jobs_path(), created on first use.'''
+
+    def __init__(self, jobs_path, filename='.shared.db'):
+        self.jobs_path = jobs_path
+        self.filename = filename
+        self._ready = set()
+        self._lock = threading.Lock()
+
+    def path(self, name):
+        root = os.path.abspath(self.jobs_path())
+        if not os.path.isdir(root):
+            try:
+                os.makedirs(root)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        return os.path.join(root, name)
+
+    def connect(self):
+        db = self.path(self.filename)
+        with self._lock:
+            if db not in self._ready:
+                conn = self._connect(db)
+                try:
+                    conn.executescript(SCHEMA)
+                finally:
+                    conn.close()
+                self._ready.add(db)
+        return self._connect(db)
+
+    def _connect(self, db):
+        conn = sqlite3.connect(db, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        '''a connection in a write transaction, committed if the block does not raise.'''
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            yield conn
+            conn.execute('COMMIT')
+        finally:
+            conn.close()  # rolls back what was not committed
+
+    def query(self, sql, args=()):
+        conn = self.connect()
+        try:
+            return conn.execute(sql, args).fetchall()
+        finally:
+            conn.close()
+
+
+class Registry(object):
+    '''the running jobs of every worker, with the interface of jobs.JobRegistry.
+
+    The jobs of this worker are handed out as they were added (with their process and
+    lock); the others are loaded from the database, with a lock of their own.'''
+
+    def __init__(self, store):
+        self.store = store
+        self._local = {}  # job_id -> job owned by this worker
+        self._lock = threading.Lock()
+
+    def add(self, job):
+        '''register the job, or return why it conflicts with a running one.'''
+        info = job['job_info']
+        job_id, serial = info['job_id'], info['env']['ANDROID_SERIAL']
+        with self.store.transaction() as conn:
+            if conn.execute('SELECT 1 FROM running WHERE job_id = ?', (job_id,)).fetchone():
+                return 'A job with the same job_id is running! If you want to re-run the job, please stop the running one firestly.'
+            if info['exclusive'] and conn.execute('SELECT 1 FROM running WHERE serial = ? AND exclusive = 1', (serial,)).fetchone():
+                return 'A job on device with the same ANDROID_SERIAL is running!'
+            conn.execute('INSERT INTO running VALUES (?, ?, ?, ?, ?, ?)',
+                         (job_id, serial, int(bool(info['exclusive'])), os.getpid(), job.get('callback'), json.dumps(info)))
+        with self._lock:
+            self._local[job_id] = job
+
+    def update(self, job):
+        '''save the job_info of a job of this worker once it changed.'''
+        info = job['job_info']
+        with self.store.transaction() as conn:
+            conn.execute('UPDATE running SET info = ? WHERE job_id = ? AND owner = ?', (json.dumps(info), info['job_id'], os.getpid()))
+
+    def remove(self, job):
+        job_id = job['job_info']['job_id']
+        with self._lock:
+            if self._local.get(job_id) is not job:
+                return
+            del self._local[job_id]
+        with self.store.transaction() as conn:
+            conn.execute('DELETE FROM running WHERE job_id = ? AND owner = ?', (job_id, os.getpid()))
+
+    def get(self, job_id):
+        rows = self.store.query('SELECT job_id, info FROM running WHERE job_id = ?', (job_id,))
+        return self._job(*rows[0]) if rows else None
+
+    def is_free(self, serial, exclusive=True):
+        '''whether a job could start on the device now.'''
+        return not exclusive or not self.store.query('SELECT 1 FROM running WHERE serial = ? AND exclusive = 1', (serial,))
+
+    def __len__(self):
+        return self.store.query('SELECT COUNT(*) FROM running')[0][0]
+
+    def all(self):
+        return [self._job(*row) for row in self.store.query('SELECT job_id, info FROM running')]
+
+    def _job(self, job_id, info):
+        with self._lock:
+            job = self._local.get(job_id)
+        return job if job is not None else {'job_info': json.loads(info), 'lock': threading.Lock()}
+
+    def orphans(self):
+        '''[(job_id, owner)] of the jobs whose worker is gone.'''
+        me = os.getpid()
+        return [(job_id, owner) for job_id, owner in self.store.query('SELECT job_id, owner FROM running')
+                if owner != me and not reaper.exists(owner)]
+
+    def adopt(self, job_id, owner):
+        '''make the orphaned job ours; returns it, or None if another worker was faster.'''
+        with self.store.transaction() as conn:
+            claimed = conn.execute('UPDATE running SET owner = ? WHERE job_id = ? AND owner = ?', (os.getpid(), job_id, owner)).rowcount
+            row = conn.execute('SELECT info, callback FROM running WHERE job_id = ?', (job_id,)).fetchone()
+        if not claimed:
+            return None
+        job = {'job_info': json.loads(row[0]), 'lock': threading.Lock(), 'callback': row[1]}
+        with self._lock:
+            self._local[job_id] = job
+        return job
+
+
+class Queue(object):
+    '''the job queue of every worker, with the interface of scheduler.JobQueue.
+
+    The specs pushed by this worker are handed out as they were pushed, so that the
+    result dispatch() puts in them reaches the request waiting for it.'''
+
+    def __init__(self, store):
+        self.store = store
+        self._pushed = {}  # job_id -> (spec pushed by this worker, push count when it was)
+        self._pushes = 0
+        self._lock = threading.Lock()
+
+    def push(self, spec):
+        with self.store.transaction() as conn:
+            if conn.execute('SELECT 1 FROM queue WHERE job_id = ?', (spec['job_id'],)).fetchone():
+                return False
+            conn.execute('INSERT INTO queue (job_id, rank, spec) VALUES (?, ?, ?)',
+                         (spec['job_id'], -int(spec.get('priority', 0)), json.dumps(spec)))
+        with self._lock:
+            self._pushes += 1
+            self._pushed[spec['job_id']] = (spec, self._pushes)
+        return True
+
+    def remove(self, job_id):
+        with self.store.transaction() as conn:
+            row = conn.execute('SELECT spec FROM queue WHERE job_id = ?', (job_id,)).fetchone()
+            conn.execute('DELETE FROM queue WHERE job_id = ?', (job_id,))
+        with self._lock:
+            spec = self._pushed.pop(job_id, (None, 0))[0]
+        return None if row is None else spec or json.loads(row[0])
+
+    def get(self, job_id):
+        rows = self.store.query('SELECT spec FROM queue WHERE job_id = ?', (job_id,))
+        with self._lock:
+            return (self._spec(job_id) or json.loads(rows[0][0])) if rows else None
+
+    def ordered(self):
+        with self._lock:
+            pushes = self._pushes
+        rows = self.store.query('SELECT job_id, spec FROM queue ORDER BY rank, seq')
+        with self._lock:
+            queued = set(job_id for job_id, spec in rows)
+            for job_id, (spec, pushed) in list(self._pushed.items()):
+                if pushed <= pushes and job_id not in queued:
+                    del self._pushed[job_id]  # in the database before the query, so dispatched or removed by another worker
+            return [self._spec(job_id) or json.loads(spec) for job_id, spec in rows]
+
+    def _spec(self, job_id):
+        return self._pushed.get(job_id, (None, 0))[0]
+
+    def position(self, job_id):
+        for i, spec in enumerate(self.ordered()):
+            if spec['job_id'] == job_id:
+                return i
+        return None
+
+    def __len__(self):
+        return self.store.query('SELECT COUNT(*) FROM queue')[0][0]
+
+
+class FileLock(object):
+    '''a lock between the workers, on the file at path(); flock is polled so that a gevent worker keeps serving while it waits.'''
+
+    def __init__(self, path, interval=0.005):
+        self.path = path
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._fd = None
+
+    def acquire(self):
+        self._lock.acquire()
+        try:
+            fd = os.open(self.path(), os.O_RDWR | os.O_CREAT, 0o644)
+            while not try_flock(fd):
+                time.sleep(self.interval)
+            self._fd = fd
+        except:
+            self._lock.release()
+            raise
+
+    def release(self):
+        fd, self._fd = self._fd, None
+        os.close(fd)  # and the flock with it
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class Leadership(object):
+    '''the flock on the file at path() of the worker doing some work for all of them; it is
+    taken by the first worker asking while it is free, and held until resign() or its death.'''
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._lock = threading.Lock()
+
+    def elect(self):
+        '''whether this worker leads, becoming the leader if none is.'''
+        with self._lock:
+            if self._fd is None:
+                fd = os.open(self.path(), os.O_RDWR | os.O_CREAT, 0o644)
+                if try_flock(fd):
+                    self._fd = fd
+                else:
+                    os.close(fd)
+            return self._fd is not None
+
+    def resign(self):
+        with self._lock:
+            fd, self._fd = self._fd, None
+        if fd is not None:
+            os.close(fd)
+
+
+class EventRelay(object):
+    '''events.relay when there are several workers: the events go through the shared
+    database, and a thread of every worker feeds them all to its own event streams,
+    with the ids of the database.
+
+    The events every worker sees for itself (device changes, from its own tracker) are
+    published by one of them only, the one holding the events lock file.'''
+
+    interval = 0.1  # seconds between two reads of the new events
+    keep = 10000  # events kept in the database
+
+    def __init__(self, store):
+        self.store = store
+        self.leader = False
+        self._leadership = Leadership(lambda: store.path('.events.lock'))
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, name='event-relay')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def publish(self, type, data, duplicated=False):
+        self.start()
+        if duplicated and not self.leader:
+            return
+        with self.store.transaction() as conn:
+            id = conn.execute('INSERT INTO events (type, time, data) VALUES (?, ?, ?)', (type, time.time(), json.dumps(data))).lastrowid
+            if id % 100 == 0:
+                conn.execute('DELETE FROM events WHERE id <= ?', (id - self.keep,))
+
+    def run(self):
+        last_id = None
+        while True:
+            try:
+                self.elect()
+                if last_id is None:
+                    last_id = (self.store.query('SELECT MAX(id) FROM events')[0][0] or 0) - events.backlog
+                for id, type, at, data in self.store.query('SELECT id, type, time, data FROM events WHERE id > ? ORDER BY id', (last_id,)):
+                    events.append(id, type, at, json.loads(data))
+                    last_id = id
+            except Exception:
+                pass  # the database is busy or gone for now, next round
+            time.sleep(self.interval)
+
+    def elect(self):
+        '''become the worker publishing the duplicated events, if none is.'''
+        if self.leader or not self._leadership.elect():
+            return
+        self.leader = True
+        self.publish('device.resync', {}, duplicated=True)  # whatever the previous leader missed
+
+
+class StatShare(object):
+    '''stats.share when there are several workers: the worker holding the stats lock file
+    samples the devices and saves the samples in the shared database, where the other
+    workers read them.'''
+
+    def __init__(self, store):
+        self.store = store
+        self._leadership = Leadership(lambda: store.path('.stats.lock'))
+        self._last_ids = {}  # serial -> id of the last sample read
+
+    def elect(self):
+        try:
+            return self._leadership.elect()
+        except OSError:
+            return False
+
+    def put(self, serial, sample, keep):
+        '''save a sample of the device, and forget those older than keep seconds.'''
+        with self.store.transaction() as conn:
+            conn.execute('INSERT INTO samples (serial, time, data) VALUES (?, ?, ?)', (serial, sample['time'], json.dumps(sample)))
+            conn.execute('DELETE FROM samples WHERE serial = ? AND time < ?', (serial, sample['time'] - keep))
+
+    def read(self, serial):
+        '''the samples of the device saved since the previous read.'''
+        rows = self.store.query('SELECT id, data FROM samples WHERE serial = ? AND id > ? ORDER BY id', (serial, self._last_ids.get(serial, 0)))
+        if rows:
+            self._last_ids[serial] = rows[-1][0]
+        return [json.loads(data) for id, data in rows]
+
+
+class ScreenShare(object):
+    '''screen.share when there are several workers: the latest screencap of every device
+    is kept in a file under .screen, so that a screen gets captured once for all of them.
+
+    The screen stream of a device is captured by the worker holding its lock file; the
+    others follow its frames, and tell it the fps their viewers want in files of their own.'''
+
+    header = struct.Struct('<d')  # the capture time, before the screencap output
+
+    def __init__(self, store):
+        self.store = store
+        self._locks = {}  # serial -> FileLock of the captures outside of a stream
+        self._leaderships = {}  # serial -> Leadership of the stream
+        self._lock = threading.Lock()
+
+    def path(self, name):
+        directory = self.store.path('.screen')
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        return os.path.join(directory, name)
+
+    def frame(self, serial, known=None):
+        '''(captured at, refreshed at, screencap output) of the latest capture of the device,
+        without the output if it was captured at known; None if there is none.'''
+        try:
+            with open(self.path('%s.frame' % serial), 'rb') as f:
+                refreshed = os.fstat(f.fileno()).st_mtime
+                captured, = self.header.unpack(f.read(self.header.size))
+                return captured, refreshed, None if captured == known else f.read()
+        except (IOError, OSError, struct.error):
+            return None
+
+    def put_frame(self, serial, captured, data):
+        path = self.path('%s.frame' % serial)
+        tmp = '%s.%d' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(self.header.pack(captured))
+            f.write(data)
+        os.rename(tmp, path)
+
+    def touch_frame(self, serial):
+        '''mark the latest capture of the device as still current.'''
+        try:
+            os.utime(self.path('%s.frame' % serial), None)
+        except OSError:
+            pass
+
+    def lock(self, serial):
+        '''the lock of the workers capturing the screen of the device outside of a stream.'''
+        with self._lock:
+            if serial not in self._locks:
+                self._locks[serial] = FileLock(lambda: self.path('%s.lock' % serial))
+            return self._locks[serial]
+
+    def lead(self, serial):
+        '''whether this worker captures the stream of the device, becoming its capturer if none is.'''
+        with self._lock:
+            if serial not in self._leaderships:
+                self._leaderships[serial] = Leadership(lambda: self.path('%s.stream' % serial))
+            leadership = self._leaderships[serial]
+        return leadership.elect()
+
+    def want(self, serial, fps):
+        '''tell the capturer of the stream that viewers here want fps, for the next few seconds.'''
+        with open(self.path('%s.%d.fps' % (serial, os.getpid())), 'w') as f:
+            f.write(str(fps))
+
+    def wanted(self, serial, max_age=3):
+        '''the highest fps the viewers of the other workers want, 0 if none.'''
+        result = 0
+        for name in os.listdir(self.path('')):
+            of, sep, pid = name[:-len('.fps')].rpartition('.')
+            if name.endswith('.fps') and of == serial and pid != str(os.getpid()):
+                try:
+                    path = self.path(name)
+                    if time.time() - os.stat(path).st_mtime > max_age:
+                        os.remove(path)  # its viewers are gone
+                        continue
+                    with open(path) as f:
+                        result = max(result, float(f.read()))
+                except (IOError, OSError, ValueError):
+                    pass
+        return result
+
+    def leave(self, serial):
+        '''stop capturing or following the stream of the device.'''
+        try:
+            os.remove(self.path('%s.%d.fps' % (serial, os.getpid())))
+        except OSError:
+            pass
+        with self._lock:
+            leadership = self._leaderships.pop(serial, None)
+        if leadership is not None:
+            leadership.resign()
+
+
+def try_flock(fd):
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except IOError as e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        return False
+
+
+def running(pid, marker):
+    '''whether the process pid is alive and has marker in its command line (its pid was not reused).'''
+    try:
+        with open('/proc/%d/cmdline' % pid, 'rb') as f:
+            return marker.encode('utf-8') in f.read()
+    except IOError:
+        return not os.path.isdir('/proc') and reaper.exists(pid)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''In process metrics, exposed in the prometheus text format at /api/metrics.
+
+Recording is a lock, a dict lookup and an addition (plus a bisect for histograms),
+so it can sit on the request path; everything else happens when /api/metrics is
+scraped. Gauges of values the server already knows (running jobs...) are given a
+function and computed at scrape time only.
+
+    latency = metrics.histogram('adb_command_duration_seconds', 'adb commands.', ['serial', 'command'])
+    with metrics.timer(latency, (serial, 'shell')):
+        ...
+'''
+
+import bisect
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from bottle import response, HTTPResponse
+
+default_buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+_metrics = OrderedDict()  # name -> metric, in registration order
+_metrics_lock = threading.Lock()
+
+split_hook = None  # split_hook(split, seconds) for the observations of histograms with a split, see profiling
+
+
+def account(split, seconds):
+    '''add seconds to a split of the profiled request, for time it waits on work other threads do for it.'''
+    if split_hook:
+        split_hook(split, seconds)
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}  # label values -> value
+        self._lock = threading.Lock()
+
+    def samples(self):
+        '''[(suffix, label values, extra labels, value)] to expose.'''
+        with self._lock:
+            return [('', labels, (), value) for labels, value in sorted(self._values.items())]
+
+    def expose(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.type)]
+        for suffix, values, extra, value in self.samples():
+            pairs = list(zip(self.labels, values)) + list(extra)
+            labels = ','.join('%s="%s"' % (k, escape(v)) for k, v in pairs)
+            lines.append('%s%s%s %s' % (self.name, suffix, '{%s}' % labels if labels else '', format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    '''a gauge set by the code, or computed at scrape time by fn() returning a value, or {label values: value}.'''
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=(), fn=None):
+        Metric.__init__(self, name, help, labels)
+        self.fn = fn
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._values[labels] = value
+
+    def samples(self):
+        if self.fn is None:
+            return Metric.samples(self)
+        value = self.fn()
+        values = value if isinstance(value, dict) else {(): value}
+        return [('', labels, (), v) for labels, v in sorted(values.items())]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=default_buckets, split=None):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self.split = split  # where the observed time goes in the request profile: "adb", "disk" or "lock"
+
+    def observe(self, value, labels=()):
+        if self.split and split_hook:
+            split_hook(self.split, value)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.]
+            entry[0][i] += 1
+            entry[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in sorted(self._values.items())]
+        result = []
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                result.append(('_bucket', labels, (('le', format_value(bound)),), cumulative))
+            result.append(('_sum', labels, (), total))
+            result.append(('_count', labels, (), cumulative))
+        return result
+
+
+def register(metric):
+    with _metrics_lock:
+        return _metrics.setdefault(metric.name, metric)
+
+
+def counter(name, help, labels=()):
+    return register(Counter(name, help, labels))
+
+
+def gauge(name, help, labels=(), fn=None):
+    return register(Gauge(name, help, labels, fn))
+
+
+def histogram(name, help, labels=(), buckets=default_buckets, split=None):
+    return register(Histogram(name, help, labels, buckets, split))
+
+
+@contextmanager
+def timer(histogram, labels=()):
+    started = time.time()
+    try:
+        yield
+    finally:
+        histogram.observe(time.time() - started, labels)
+
+
+class TimedLock(object):
+    '''a lock recording how long it was waited for and held.'''
+
+    def __init__(self, name, lock=None):
+        self.name = name
+        self._lock = lock or threading.Lock()
+        self._acquired = None
+
+    def __enter__(self):
+        started = time.time()
+        self._lock.acquire()
+        self._acquired = time.time()
+        lock_wait.observe(self._acquired - started, (self.name,))
+        return self
+
+    def __exit__(self, *exc_info):
+        held = time.time() - self._acquired
+        self._lock.release()
+        lock_hold.observe(held, (self.name,))
+
+
+class Plugin(object):
+    '''bottle plugin recording the latency of every route of the app it is installed in.'''
+    name = 'metrics'
+    api = 2
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+
+    def apply(self, callback, route):
+        labels = (route.method, self.prefix + route.rule)
+
+        def wrapper(*args, **kwargs):
+            started, status = time.time(), 500
+            try:
+                body = callback(*args, **kwargs)
+                status = (body if isinstance(body, HTTPResponse) else response).status_code  # static_file returns its errors
+                return body
+            except HTTPResponse as e:
+                status = e.status_code
+                raise
+            finally:
+                request_latency.observe(time.time() - started, labels + (str(status),))
+        return wrapper
+
+
+def expose():
+    with _metrics_lock:
+        metrics = list(_metrics.values())
+    return '\n'.join(m.expose() for m in metrics) + '\n'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+request_latency = histogram('http_request_duration_seconds', 'Time spent in the route handlers.', ['method', 'route', 'code'])
+lock_wait = histogram('lock_wait_seconds', 'Time spent waiting for the server locks.', ['lock'], (.0001, .001, .005, .01, .05, .1, .5, 1, 5), 'lock')
+lock_hold = histogram('lock_hold_seconds', 'Time the server locks were held.', ['lock'], (.0001, .001, .005, .01, .05, .1, .5, 1, 5))
+disk_io = histogram('disk_io_duration_seconds', 'Time spent in the disk io of the request handlers, by operation.', ['op'], split='disk')
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Bare mirrors of the job repositories, shared by every job of the workstation.
+
+The job script calls `python mirrors.py prepare --root <root> <url>` before cloning:
+it creates or fetches the mirror of the url under a per-repo file lock and prints its
+path, which the job then clones from with `git clone --reference`. Nothing is printed
+when the mirror cannot be prepared, and the job falls back to a plain clone. A mirror
+fetched less than `refresh` seconds ago is used as it is: the clone fetches whatever it
+lacks from the url anyway.
+
+Then the job starts `python mirrors.py maintain --root <root>` in the background, which
+runs `git gc` on the mirrors not collected for `gc_interval` seconds and removes those
+not used for `max_age` seconds. The gc keeps the unreachable objects a job may still
+borrow for git's grace period (two weeks) before pruning them.
+'''
+
+from bottle import Bottle, request
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+import paths
+
+app = Bottle()
+app.config.setdefault('mirrors.enabled', True)
+app.config.setdefault('mirrors.path', '/home/pi/mirrors')
+app.config.setdefault('mirrors.refresh_interval', 60)  # seconds a mirror is cloned from without fetching it again
+app.config.setdefault('mirrors.gc_interval', 24 * 3600)  # seconds between two git gc of a mirror
+app.config.setdefault('mirrors.max_age', 30 * 24 * 3600)  # seconds an unused mirror is kept
+
+
+@app.get("/")
+def mirror_stats():
+    '''usage and hit/miss stats of the repo mirrors, with their disk usage when ?size=true.'''
+    root = app.config.get('mirrors.path')
+    result = stats(root)
+    if request.params.get('size', 'false') not in ['false', '0', 'False']:
+        for url, item in result['mirrors'].items():
+            item['size'] = paths.disk_usage(mirror_path(root, url))
+    return result
+
+
+def mirror_path(root, url):
+    return os.path.join(root, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.git')
+
+
+@contextmanager
+def flock(filename, wait=True):
+    '''hold the lock file; without wait, yield False at once when it is taken.'''
+    with open(filename, 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+        except (IOError, OSError):
+            if wait:
+                raise
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def stamp(path, name):
+    '''touch the stamp file name of the mirror at path.'''
+    with open(os.path.join(path, name), 'a'):
+        pass
+    os.utime(os.path.join(path, name), None)
+
+
+def stamped(path, name):
+    '''when the stamp file name of the mirror at path was touched, 0 if never.'''
+    try:
+        return os.stat(os.path.join(path, name)).st_mtime
+    except OSError:
+        return 0
+
+
+def prepare(root, url, refresh=0):
+    '''create or update the mirror of url, unless it was fetched less than refresh seconds ago, and return its path.'''
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    path = mirror_path(root, url)
+    started = time.time()
+    with flock(path + '.lock'):
+        hit = os.path.isdir(path)
+        if hit:
+            if time.time() - stamped(path, 'mirror.fetched') >= refresh:
+                subprocess.check_call(['git', '--git-dir', path, 'remote', 'update', '--prune'], stdout=sys.stderr)
+                stamp(path, 'mirror.fetched')
+        else:
+            shutil.rmtree(path + '.tmp', ignore_errors=True)
+            subprocess.check_call(['git', 'clone', '--mirror', '--quiet', url, path + '.tmp'], stdout=sys.stderr)
+            # jobs borrow objects from the mirror, git must never prune them on its own: maintain() does.
+            subprocess.check_call(['git', '--git-dir', path + '.tmp', 'config', 'gc.auto', '0'])
+            for name in ('mirror.fetched', 'mirror.gc'):
+                stamp(path + '.tmp', name)
+            os.rename(path + '.tmp', path)
+    record(root, url, hit, time.time() - started)
+    return path
+
+
+def maintain(root, gc_interval, max_age):
+    '''gc the mirrors not collected for gc_interval seconds, and remove those not used for max_age seconds.
+
+    The mirrors a job is preparing are skipped, and so is everything when another maintain() runs.'''
+    with flock(os.path.join(root, 'maintain.lock'), wait=False) as locked:
+        if not locked:
+            return
+        for url, item in sorted(stats(root)['mirrors'].items()):
+            path = mirror_path(root, url)
+            with flock(path + '.lock', wait=False) as locked:
+                if not locked:
+                    continue
+                if time.time() - item.get('last_used', 0) > max_age:
+                    shutil.rmtree(path, ignore_errors=True)
+                    forget(root, url)
+                elif os.path.isdir(path) and time.time() - stamped(path, 'mirror.gc') >= gc_interval:
+                    subprocess.call(['git', '--git-dir', path, 'gc', '--quiet'], stdout=sys.stderr)
+                    stamp(path, 'mirror.gc')
+
+
+def record(root, url, hit, seconds):
+    with flock(os.path.join(root, 'stats.lock')):
+        all = stats(root)
+        item = all['mirrors'].setdefault(url, {'hits': 0, 'misses': 0, 'path': mirror_path(root, url)})
+        item['hits' if hit else 'misses'] += 1
+        item['last_used'] = time.time()
+        item['last_update_seconds'] = seconds
+        save(root, all)
+
+
+def forget(root, url):
+    with flock(os.path.join(root, 'stats.lock')):
+        all = stats(root)
+        all['mirrors'].pop(url, None)
+        save(root, all)
+
+
+def save(root, all):
+    all['hits'] = sum(i['hits'] for i in all['mirrors'].values())
+    all['misses'] = sum(i['misses'] for i in all['mirrors'].values())
+    with open(os.path.join(root, 'stats.json.tmp'), 'w') as f:
+        f.write(json.dumps(all, sort_keys=True, indent=2))
+    os.rename(os.path.join(root, 'stats.json.tmp'), os.path.join(root, 'stats.json'))
+
+
+def stats(root):
+    try:
+        with open(os.path.join(root, 'stats.json')) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {'hits': 0, 'misses': 0, 'mirrors': {}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='shared git mirrors of the job repositories')
+    actions = parser.add_subparsers(dest='action')
+    prepare_parser = actions.add_parser('prepare', help='print the path of the mirror of url, creating or updating it')
+    prepare_parser.add_argument('--root', default=app.config.get('mirrors.path'))
+    prepare_parser.add_argument('--refresh', type=float, default=app.config.get('mirrors.refresh_interval'), help='seconds')
+    prepare_parser.add_argument('url')
+    maintain_parser = actions.add_parser('maintain', help='gc the mirrors and remove the unused ones')
+    maintain_parser.add_argument('--root', default=app.config.get('mirrors.path'))
+    maintain_parser.add_argument('--gc-interval', type=float, default=app.config.get('mirrors.gc_interval'), help='seconds')
+    maintain_parser.add_argument('--max-age', type=float, default=app.config.get('mirrors.max_age'), help='seconds')
+    args = parser.parse_args()
+    if args.action == 'maintain':
+        if os.path.isdir(args.root):
+            maintain(args.root, args.gc_interval, args.max_age)
+        return
+    try:
+        print(prepare(args.root, args.url, args.refresh))
+    except (OSError, subprocess.CalledProcessError) as e:
+        sys.stderr.write('Failed to prepare the mirror of %s: %s\n' % (args.url, e))
+
+if __name__ == '__main__':
+    main()
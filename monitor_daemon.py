@@ -1,14 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import hashlib
 import logging
 import time
 import os
 import json
 import requests
 import re
+import threading
 from daemon import runner
 from kazoo.client import KazooClient
+from kazoo.exceptions import NodeExistsError, NoNodeError
 
 dev = os.environ.get('DEVELOPMENT', 'false').lower() == 'true'
 
@@ -21,6 +24,12 @@ class App():
         self.stderr_path = '/dev/null'
         self.pidfile_path = '%s/monitor_daemon.pid' % ('/tmp' if dev else '/var/run')
         self.pidfile_timeout = 5
+        self.condition = threading.Condition()
+        self.dirty = set()  # parts of the server info to fetch again: "api", "devices", "jobs"
+        self.changes = 0
+        self.streaming = False
+        self.session = None  # zk session the written digests belong to
+        self.written = {}  # znode path -> sha1 of the payload written to it
 
     def mac_and_ip(self, eth):
         import subprocess
@@ -34,7 +43,6 @@ class App():
     def run(self):
         server_info = self.mac_and_ip(os.environ.get('MONITOR_INTERFACE', 'eth0'))
 
-        zk_path = '/remote/alive/workstation/%s' % server_info['mac']
         zk = KazooClient(hosts=os.environ.get('ZOOKEEPER', 'zookeeper_server:2181'))
         sleep_time = 10
         while not zk.connected:
@@ -43,61 +51,150 @@ class App():
             except:
                 pass
             time.sleep(sleep_time)
-        web_keyname, has_error, device_loop, loop = 'api', False, int(10 / sleep_time), 0
-        server_info[web_keyname] = {}
+        web_keyname, has_error = 'api', False
+        server_info[web_keyname] = {'port': int(os.environ.get('MONITOR_PORT', 80)), 'path': '/api'}
+        url = 'http://%s:%d' % (server_info['ip'], server_info[web_keyname]['port'])
+
+        listener = threading.Thread(target=self.listen, args=(url,))
+        listener.daemon = True
+        listener.start()
+        parts = self.all_parts
         while True:
             try:
                 if not zk.connected:
                     zk.restart()
                     logger.info('Restart zk connection!')
-                if not zk.exists(zk_path):
-                    value = json.dumps(server_info)
-                    zk.create(zk_path, value, ephemeral=True, makepath=True)
-                    logger.info('Create ZK %s: %s' % (zk_path, value))
-                server_info[web_keyname].update({'port': int(os.environ.get('MONITOR_PORT', 80)), 'path': '/api'})
-                url = 'http://%s:%d' % (server_info['ip'], server_info[web_keyname]['port'])
-
-                try:
-                    r = requests.get('%s/api/ping' % url)
-                    if r.status_code == 200:
-                        server_info[web_keyname]['status'] = 'up'
-                    else:
-                        logger.error("%s --- %s" % (r.url, r.text))
-                except Error as e:
-                    logger.error(e)
-                    server_info[web_keyname]['status'] = 'down'
-                    server_info[web_keyname]['devices'] = {}
-                    server_info[web_keyname]['jobs'] = []
-                else:
-                    if loop == 0:  # we want not to query devices so frequently, so...
-                        devices = requests.get('%s/api/0/devices' % url)
-                        if devices.status_code == 200:
-                            server_info[web_keyname]['devices'] = devices.json()
-                        else:
-                            logger.error("%s --- %s" % (devices.url, devices.text))
-                            server_info[web_keyname]['devices'] = {}
-
-                    jobs = requests.get('%s/api/0/jobs' % url, params={'all': False})
-                    if jobs.status_code == 200:
-                        server_info[web_keyname]['jobs'] = jobs.json()['jobs']
-                    else:
-                        logger.error("%s --- %s" % (jobs.url, jobs.text))
-                        server_info[web_keyname]['jobs'] = []
-
-                data, stat = zk.get(zk_path)
-                if data and json.loads(data) != server_info:
-                    value = json.dumps(server_info)
-                    zk.set(zk_path, value)
-                    logger.info('Update ZK %s: %s' % (zk_path, value))
+                self.refresh(url, parts, server_info[web_keyname])
+                self.sync(zk, self.nodes(server_info))
             except:
-                loop = 0
+                with self.condition:
+                    self.dirty.update(self.all_parts)  # retried on the next round
                 if not has_error:
                     logger.error("Connection error!")
                     has_error = True
             else:
                 has_error = False
-                loop = (loop + 1) % device_loop
-            time.sleep(sleep_time)
+            parts = self.wait_for_changes(sleep_time)
+
+    all_parts = ('api', 'devices', 'jobs')
+    debounce = 0.2  # seconds without events before a burst of them is handled
+    max_delay = 1  # seconds a change may wait for the end of a burst
+    retry_time = 5  # seconds before reconnecting to the event stream
+
+    def changed(self, parts, streaming=None):
+        with self.condition:
+            self.dirty.update(parts)
+            self.changes += 1
+            if streaming is not None:
+                self.streaming = streaming
+            self.condition.notify_all()
+
+    def listen(self, url):
+        '''follow the event stream of the web server, marking what its events changed.'''
+        while True:
+            try:
+                r = requests.get('%s/api/0/events' % url, stream=True, timeout=60)  # the server sends a keepalive every 15s
+                if r.status_code != 200:
+                    raise IOError('%s --- %s' % (r.url, r.status_code))
+                self.changed(self.all_parts, streaming=True)  # whatever happened while we were not listening
+                logger.info('Listening to %s' % r.url)
+                for line in r.iter_lines(chunk_size=1):
+                    if line.startswith(b'event: '):
+                        kind = line[len(b'event: '):].decode('utf-8').split('.')[0]
+                        if kind in ('job', 'device'):
+                            self.changed([kind + 's'])
+                        elif kind == 'resync':
+                            self.changed(self.all_parts)
+            except Exception as e:
+                logger.error('Event stream error: %s' % e)
+            self.changed([], streaming=False)
+            time.sleep(self.retry_time)
+
+    def wait_for_changes(self, poll_time):
+        '''the parts to refresh: what the events changed, debounced, or everything every poll_time without the stream.'''
+        with self.condition:
+            deadline = time.time() + poll_time
+            while not self.dirty and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+            if not self.dirty:
+                return () if self.streaming else self.all_parts
+            first = time.time()
+            while time.time() - first < self.max_delay:
+                changes = self.changes
+                self.condition.wait(min(self.debounce, self.max_delay - (time.time() - first)))
+                if self.changes == changes:
+                    break
+            parts, self.dirty = tuple(self.dirty), set()
+            return parts
+
+    def nodes(self, server_info):
+        '''znode path -> compact json payload: a small ephemeral node for the workstation,
+        and one ephemeral child per device and per job under its persistent parents.'''
+        mac, api = server_info['mac'], server_info['api']
+        workstation = dict(server_info, api=dict((k, v) for k, v in api.items() if k not in ('devices', 'jobs')))
+        result = {'/remote/alive/workstation/%s' % mac: workstation}
+        for device in api.get('devices', {}).get('android', []):
+            result['/remote/workstation/%s/devices/%s' % (mac, device['adb']['serial'])] = device
+        for job in api.get('jobs', []):
+            result['/remote/workstation/%s/jobs/%s' % (mac, job['job_id'])] = job
+        return dict((path, json.dumps(value, sort_keys=True, separators=(',', ':')).encode('utf-8')) for path, value in result.items())
+
+    def sync(self, zk, nodes):
+        '''write the nodes whose payload changed since the last sync and delete the ones gone,
+        comparing with the digests of what was written instead of reading it back.'''
+        session = zk.client_id
+        if session != self.session:
+            self.session, self.written = session, {}  # the ephemeral nodes of another session are not ours to trust
+        for path, value in sorted(nodes.items()):
+            digest = hashlib.sha1(value).hexdigest()
+            if self.written.get(path) == digest:
+                continue
+            try:
+                zk.create(path, value, ephemeral=True, makepath=True)
+            except NodeExistsError:
+                stat = zk.exists(path)
+                if stat and stat.ephemeralOwner == session[0]:
+                    zk.set(path, value)
+                else:  # left by a previous session, would vanish when it expires
+                    zk.delete(path)
+                    zk.create(path, value, ephemeral=True, makepath=True)
+            self.written[path] = digest
+            logger.info('Update ZK %s: %s' % (path, value.decode('utf-8')))
+        for path in [p for p in self.written if p not in nodes]:
+            try:
+                zk.delete(path)
+            except NoNodeError:
+                pass
+            del self.written[path]
+            logger.info('Delete ZK %s' % path)
+
+    def refresh(self, url, parts, info):
+        try:
+            if 'api' in parts:
+                r = requests.get('%s/api/ping' % url)
+                if r.status_code == 200:
+                    info['status'] = 'up'
+                else:
+                    logger.error("%s --- %s" % (r.url, r.text))
+            if 'devices' in parts:
+                devices = requests.get('%s/api/0/devices' % url)
+                if devices.status_code == 200:
+                    info['devices'] = devices.json()
+                else:
+                    logger.error("%s --- %s" % (devices.url, devices.text))
+                    info['devices'] = {}
+            if 'jobs' in parts:
+                jobs = requests.get('%s/api/0/jobs' % url, params={'all': False})
+                if jobs.status_code == 200:
+                    info['jobs'] = jobs.json()['jobs']
+                else:
+                    logger.error("%s --- %s" % (jobs.url, jobs.text))
+                    info['jobs'] = []
+        except requests.RequestException as e:
+            logger.error(e)
+            info['status'] = 'down'
+            info['devices'] = {}
+            info['jobs'] = []
 
 app = App()
 logger = logging.getLogger("DaemonLog")
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''The threading and sleeping functions as they were before gevent monkey patching.
+
+Under the gunicorn gevent worker, threads are greenlets and select.poll is gone; what
+has to block for real (a sampling profiler...) runs on an os thread started here.'''
+
+import time
+
+try:
+    import _thread as thread_module
+except ImportError:
+    import thread as thread_module
+
+
+def original(module, name, default):
+    '''the function before gevent monkey patching, default when it was not patched.'''
+    try:
+        from gevent import monkey
+        return monkey.get_original(module, name)
+    except (ImportError, AttributeError, KeyError):
+        return default
+
+
+def green():
+    '''whether gevent patched the threads into greenlets.'''
+    return getattr(thread_module.start_new_thread, '__module__', '').startswith('gevent')
+
+
+get_ident = original(thread_module.__name__, 'get_ident', thread_module.get_ident)
+real_sleep = original('time', 'sleep', time.sleep)
+start_os_thread = lambda fn: original(thread_module.__name__, 'start_new_thread', thread_module.start_new_thread)(fn, ())
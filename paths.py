@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Filesystem helpers of the modules that also run as scripts (mirrors, venvs).'''
+
+import os
+
+
+def script_path(module_file):
+    '''the .py file of a module, from its __file__ (which may be the .pyc).'''
+    return os.path.splitext(os.path.abspath(module_file))[0] + '.py'
+
+
+def disk_usage(path):
+    '''bytes of the files under path, without following symlinks.'''
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for f in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, f)).st_size
+            except OSError:
+                pass
+    return total
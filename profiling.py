@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Request profiling: per request wall/cpu time and where it went, plus a sampling profiler.
+
+With PROFILING=1 in the environment, app.py wraps the root app in the Middleware.
+Every request then gets its wall time, its cpu time, and the time spent in adb,
+in disk io and waiting for locks (from the metrics histograms having a split).
+Requests slower than PROFILING_SLOW_SECONDS are written as json lines to
+PROFILING_SLOW_LOG, or to stderr when it is not set.
+
+`profile(seconds)` samples the stacks of every thread and returns them folded, one
+"frame;frame;... count" line per stack, ready for flamegraph.pl or speedscope.
+Under the gevent worker, the cpu time of a request includes whatever other greenlets
+ran while it waited on io.
+'''
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+import metrics
+from native import get_ident, real_sleep, start_os_thread
+
+enabled = os.environ.get('PROFILING', '0') not in ['0', 'false', 'False', '']
+slow_seconds = float(os.environ.get('PROFILING_SLOW_SECONDS', 1))
+slow_log = os.environ.get('PROFILING_SLOW_LOG')
+stream_types = ('multipart/x-mixed-replace', 'text/event-stream')  # long by design, never logged as slow
+splits = ('adb', 'disk', 'lock')
+
+_local = threading.local()
+_profile_lock = threading.Lock()
+
+try:
+    cpu_time = time.thread_time
+except AttributeError:
+    try:
+        import resource
+        RUSAGE_THREAD = resource.RUSAGE_THREAD
+        cpu_time = lambda: sum(resource.getrusage(RUSAGE_THREAD)[:2])
+    except (ImportError, AttributeError):
+        cpu_time = time.clock
+
+
+def account(split, seconds):
+    '''add seconds to the split of the request being handled by this thread, if any.'''
+    current = getattr(_local, 'current', None)
+    if current is not None:
+        current.splits[split] = current.splits.get(split, 0) + seconds
+
+
+class RequestProfile(object):
+
+    def __init__(self, environ):
+        self.method = environ.get('REQUEST_METHOD')
+        self.path = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+        self.query = environ.get('QUERY_STRING', '')
+        self.started = time.time()
+        self.cpu = 0.
+        self.splits = {}
+        self.status = None
+        self.content_type = ''
+        self._cpu_started = None
+
+    def enter(self):
+        _local.current = self
+        self._cpu_started = cpu_time()
+
+    def leave(self):
+        self.cpu += cpu_time() - self._cpu_started
+        _local.current = None
+
+    def record(self):
+        wall = time.time() - self.started
+        result = {
+            'time': self.started,
+            'method': self.method,
+            'path': self.path,
+            'query': self.query,
+            'status': self.status,
+            'wall': round(wall, 6),
+            'cpu': round(self.cpu, 6)
+        }
+        for split in splits:
+            result[split] = round(self.splits.get(split, 0), 6)
+        result['other'] = round(max(wall - sum(self.splits.values()), 0), 6)
+        return result
+
+
+class Body(object):
+    '''the response body, profiled while the server iterates it.'''
+
+    def __init__(self, body, profile, finish):
+        self.body = body
+        self.profile = profile
+        self.finish = finish
+
+    def __iter__(self):
+        iterator = iter(self.body)
+        while True:
+            self.profile.enter()
+            try:
+                data = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.profile.leave()
+            yield data
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.finish()
+
+
+class Middleware(object):
+
+    def __init__(self, app, threshold=None, log=None):
+        self.app = app
+        self.threshold = slow_seconds if threshold is None else threshold
+        self.log = log or slow_logger()
+        metrics.split_hook = account
+
+    def __call__(self, environ, start_response):
+        profile = RequestProfile(environ)
+
+        def start(status, headers, exc_info=None):
+            profile.status = int(status.split()[0])
+            profile.content_type = dict((k.lower(), v) for k, v in headers).get('content-type', '')
+            return start_response(status, headers, exc_info) if exc_info else start_response(status, headers)
+
+        def finish():
+            record = profile.record()
+            if record['wall'] >= self.threshold and not profile.content_type.startswith(stream_types):
+                self.log.warning(json.dumps(record, sort_keys=True))
+
+        profile.enter()
+        try:
+            body = self.app(environ, start)
+        except:
+            profile.leave()
+            finish()
+            raise
+        profile.leave()
+        wrapper = environ.get('wsgi.file_wrapper')
+        if isinstance(wrapper, type) and isinstance(body, wrapper) or profile.content_type.startswith(stream_types):
+            finish()  # keep sendfile, and streams are not worth profiling for their whole life
+            return body
+        return Body(body, profile, finish)
+
+
+def slow_logger():
+    logger = logging.getLogger('slow_requests')
+    if not logger.handlers:
+        logger.addHandler(logging.FileHandler(slow_log) if slow_log else logging.StreamHandler())
+        logger.propagate = False
+    return logger
+
+
+def wrap(app):
+    '''the app wrapped in the profiling middleware when enabled, the app itself otherwise.'''
+    return Middleware(app) if enabled else app
+
+
+def profile(seconds, interval=0.005):
+    '''sample every thread's stack for seconds; returns the folded stacks, or None if a profile is running already.'''
+    if not _profile_lock.acquire(False):
+        return None
+    try:
+        counts, stop, done = {}, [], []
+
+        def sample():
+            me = get_ident()
+            try:
+                while not stop:
+                    for ident, frame in sys._current_frames().items():
+                        if ident != me:
+                            stack = fold(frame)
+                            counts[stack] = counts.get(stack, 0) + 1
+                    real_sleep(interval)
+            finally:
+                done.append(True)
+
+        start_os_thread(sample)
+        time.sleep(seconds)
+        stop.append(True)
+        while not done:  # plain flags: a gevent Event cannot be set from another os thread
+            time.sleep(interval)
+        return ''.join('%s %d\n' % item for item in sorted(counts.items(), key=lambda item: -item[1]))
+    finally:
+        _profile_lock.release()
+
+
+def fold(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
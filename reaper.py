@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import errno
+import fcntl
+import os
+import select
+import signal
+import threading
+
+import native
+
+
+class Reaper(threading.Thread):
+    '''one thread waiting for every job process, calling back the moment one exits.
+
+    It sleeps on pidfds (linux >= 5.3, python >= 3.9) or on SIGCHLD through a wakeup pipe,
+    and only ever waits for the pids it was asked to watch, so other children of the
+    server (adb commands, ...) are left to their own Popen objects. Processes that are not
+    children of the server (the jobs adopted from a dead worker) are watched through their
+    pidfd too, or checked once a second without pidfds.
+
+    Nothing is set up before the first watch. The reaper waits in select.poll on a thread
+    of its own; under gevent, where the threads are greenlets and select.poll is gone, it
+    waits in the cooperative select.select instead, so it never blocks the hub and the
+    callbacks run on it.'''
+
+    def __init__(self):
+        threading.Thread.__init__(self, name='job-reaper')
+        self.daemon = True
+        self._lock = threading.Lock()
+        self._watched = {}  # pid -> (proc, callback)
+        self._foreign = {}  # pid -> callback, for processes that are not our children
+        self._pending = []  # pids waiting to get their pidfd registered by the reaper thread
+        self._pidfds = {}  # pidfd -> pid
+        self._fd_of = {}  # pid -> pidfd
+        self._use_pidfd = hasattr(os, 'pidfd_open')
+        self._sigchld = False
+        self._wake_r = self._wake_w = None
+        self._poll = None  # select.poll(), None to use select.select
+
+    def _setup(self):
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in (self._wake_r, self._wake_w):
+            _set_nonblocking(fd)
+        if hasattr(select, 'poll') and not native.green():
+            self._poll = select.poll()
+            self._poll.register(self._wake_r, select.POLLIN)
+
+    def watch(self, proc, callback):
+        '''call callback(returncode) from the reaper thread once the Popen proc exits; returncode is None if its status got lost.'''
+        with self._lock:
+            self._watched[proc.pid] = (proc, callback)
+            self._pending.append(proc.pid)
+            self._start_once()
+        self.wake()
+
+    def watch_pid(self, pid, callback):
+        '''call callback() from the reaper thread once the process pid, not a child of ours, is gone.'''
+        with self._lock:
+            self._foreign[pid] = callback
+            self._pending.append(pid)
+            self._start_once()
+        self.wake()
+
+    def _start_once(self):
+        if not self.is_alive():
+            self._setup()
+            if not self._use_pidfd:
+                self._install_sigchld()
+            self.start()
+
+    def wake(self):
+        try:
+            os.write(self._wake_w, b'x')
+        except OSError:
+            pass  # the pipe is full, the reaper is going to wake up anyway.
+
+    def _install_sigchld(self):
+        try:
+            signal.signal(signal.SIGCHLD, lambda signum, frame: self.wake())
+            signal.siginterrupt(signal.SIGCHLD, False)
+            self._sigchld = True
+        except ValueError:
+            pass  # not the main thread: fall back to checking once a second.
+
+    def run(self):
+        while True:
+            timeout = None if self._use_pidfd or self._sigchld and not self._foreign else 1
+            ready = self._wait(timeout)
+            if self._wake_r in ready:
+                try:
+                    while os.read(self._wake_r, 4096):
+                        pass
+                except OSError:
+                    pass
+            with self._lock:
+                pending, self._pending = self._pending, []
+            for pid in pending:
+                self._register(pid)
+            if self._use_pidfd:
+                candidates = [self._pidfds[fd] for fd in ready if fd in self._pidfds] + pending
+            else:
+                with self._lock:
+                    candidates = list(self._watched) + list(self._foreign)
+            for pid in set(candidates):
+                if pid in self._foreign:
+                    self._check_foreign(pid, ready)
+                else:
+                    self._reap(pid)
+
+    def _wait(self, timeout):
+        '''the fds ready after waiting up to timeout seconds (forever with None).'''
+        if self._poll is not None:
+            return [fd for fd, event in self._poll.poll(None if timeout is None else timeout * 1000)]
+        return select.select([self._wake_r] + list(self._pidfds), [], [], timeout)[0]
+
+    def _register(self, pid):
+        if not self._use_pidfd:
+            return
+        try:
+            fd = os.pidfd_open(pid)
+        except OSError:
+            return  # already reaped, _reap will notice
+        self._pidfds[fd], self._fd_of[pid] = pid, fd
+        if self._poll is not None:
+            self._poll.register(fd, select.POLLIN)
+
+    def _reap(self, pid):
+        try:
+            waited, status = os.waitpid(pid, os.WNOHANG)
+        except OSError as e:
+            if e.errno != errno.ECHILD:
+                raise
+            waited, status = pid, None  # somebody else reaped it, the exit code is lost.
+        if waited == 0:
+            return
+        self._unregister(pid)
+        with self._lock:
+            proc, callback = self._watched.pop(pid)
+        if status is not None:
+            proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        try:
+            callback(proc.returncode)
+        except Exception:
+            pass
+
+    def _check_foreign(self, pid, ready):
+        fd = self._fd_of.get(pid)
+        if fd is not None and fd not in ready:
+            return  # its pidfd was just registered
+        if fd is None and not self._use_pidfd and exists(pid):
+            return
+        self._unregister(pid)
+        with self._lock:
+            callback = self._foreign.pop(pid)
+        try:
+            callback()
+        except Exception:
+            pass
+
+    def _unregister(self, pid):
+        fd = self._fd_of.pop(pid, None)
+        if fd is not None:
+            if self._poll is not None:
+                self._poll.unregister(fd)
+            os.close(fd)
+            del self._pidfds[fd]
+
+
+def exists(pid):
+    '''whether the process pid is alive, whoever it belongs to.'''
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _set_nonblocking(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+reaper = Reaper()
+
+
+def watch(proc, callback):
+    reaper.watch(proc, callback)
+
+
+def watch_pid(pid, callback):
+    reaper.watch_pid(pid, callback)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Code reloading for development: watch the project sources and call back after a change.
+
+Only the directories of the project itself are watched (not the virtualenv, nor the
+jobs), with inotify, and a burst of saves is reported once, when it has been quiet for
+`debounce` seconds. Without inotify, or when it cannot watch them, the mtimes of the
+project sources are polled once a second instead, with a warning. Nothing is imported nor started unless gunicorn.config.py enables it.
+'''
+
+import logging
+import os
+import threading
+import time
+
+import inotify
+
+suffixes = ('.py', '.tpl')
+skipped = ('__pycache__', 'bench')  # directories of no use to the workers
+mask = inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_CREATE | inotify.IN_DELETE
+
+
+def project_dirs(root=None):
+    '''the project directory and its subdirectories, but the hidden and skipped ones.'''
+    root = root or os.path.dirname(os.path.abspath(__file__))
+    result = []
+    for path, dirs, filenames in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.') and d not in skipped)
+        result.append(path)
+    return result
+
+
+def sources(directories):
+    return [os.path.join(d, f) for d in directories for f in os.listdir(d) if f.endswith(suffixes)]
+
+
+class Reloader(threading.Thread):
+
+    def __init__(self, callback, directories, debounce=0.5, log=None):
+        threading.Thread.__init__(self, name='reloader')
+        self.daemon = True
+        self.callback = callback
+        self.directories = directories
+        self.debounce = debounce
+        self.log = log or logging.getLogger('reloader')
+
+    def run(self):
+        watched = self.watcher()
+        if watched:
+            self.watch(*watched)
+        else:
+            self.poll()
+
+    def watcher(self):
+        '''(an inotify watcher, {wd: directory}), or None to poll instead.'''
+        if not inotify.available():
+            self.log.warning("inotify is not available; polling the sources for changes")
+            return None
+        watcher = None
+        try:
+            watcher = inotify.Inotify()
+            return watcher, dict((watcher.add_watch(d, mask), d) for d in self.directories)
+        except (OSError, IOError) as e:
+            if watcher is not None:
+                watcher.close()
+            self.log.warning("cannot watch the sources with inotify (%s); polling them for changes", e)
+            return None
+
+    def watch(self, watcher, paths):
+        while True:
+            changed = set()
+            events = watcher.read()
+            while events:
+                changed.update(os.path.join(paths[wd], name) for wd, event_mask, name in events if wd in paths and name.endswith(suffixes))
+                events = watcher.read(self.debounce)
+            if changed:
+                self.callback(sorted(changed))
+
+    def poll(self):
+        def mtimes():
+            result = {}
+            for path in sources(self.directories):
+                try:
+                    result[path] = os.stat(path).st_mtime
+                except OSError:
+                    pass
+            return result
+        known, changed = mtimes(), set()
+        while True:
+            time.sleep(max(self.debounce, 1))
+            current = mtimes()
+            new = set(p for p in set(known) | set(current) if known.get(p) != current.get(p))
+            known = current
+            changed.update(new)
+            if changed and not new:
+                self.callback(sorted(changed))
+                changed = set()
+
+
+def start(callback, directories=None, debounce=0.5, log=None):
+    '''call callback(changed paths) from a thread after every burst of changes to the sources under directories.'''
+    reloader = Reloader(callback, directories or project_dirs(), debounce, log)
+    reloader.start()
+    return reloader
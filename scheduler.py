@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import itertools
+import threading
+
+
+class JobQueue(object):
+    '''jobs waiting for their device or for a free slot on the workstation.
+
+    Jobs are dispatched by descending priority, first come first served within a priority.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}  # job_id -> (sort key, spec)
+        self._counter = itertools.count()
+
+    def push(self, spec):
+        with self._lock:
+            if spec['job_id'] in self._entries:
+                return False
+            self._entries[spec['job_id']] = ((-int(spec.get('priority', 0)), next(self._counter)), spec)
+            return True
+
+    def remove(self, job_id):
+        with self._lock:
+            entry = self._entries.pop(job_id, None)
+        return entry[1] if entry else None
+
+    def get(self, job_id):
+        with self._lock:
+            entry = self._entries.get(job_id)
+        return entry[1] if entry else None
+
+    def ordered(self):
+        with self._lock:
+            return [spec for key, spec in sorted(self._entries.values(), key=lambda entry: entry[0])]
+
+    def position(self, job_id):
+        for i, spec in enumerate(self.ordered()):
+            if spec['job_id'] == job_id:
+                return i
+        return None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+def matches(props, selector):
+    '''whether device props satisfy a {"prop": "value"} selector.'''
+    return all(props.get(k) == v for k, v in selector.items())
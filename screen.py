@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from io import BytesIO
+try:
+    import PIL.Image as Image
+except:
+    from PIL import Image
+
+import adb
+import metrics
+
+formats = {
+    'png': ('PNG', 'image/png'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'jpg': ('JPEG', 'image/jpeg'),
+    'webp': ('WEBP', 'image/webp')
+}
+
+# android PixelFormat -> (image mode, raw decoder mode, bytes per pixel)
+pixel_formats = {
+    1: ('RGBA', 'RGBA', 4),  # RGBA_8888
+    2: ('RGB', 'RGBX', 4),  # RGBX_8888
+    3: ('RGB', 'RGB', 3),  # RGB_888
+    4: ('RGB', 'BGR;16', 2),  # RGB_565
+    5: ('RGBA', 'BGRA', 4)  # BGRA_8888
+}
+
+cache_size = 64  # thumbnails kept in memory, keyed by (serial, size)
+max_age = 5  # seconds a thumbnail is served before the screen gets captured again
+
+max_fps = 10
+boundary = 'screenframe'
+
+_thumbnails = OrderedDict()
+_thumbnails_lock = threading.Lock()
+_device_locks = {}
+_streams = {}  # serial -> the live ScreenStream of that device
+
+share = None  # jobstore.ScreenShare when several workers capture each screen once for all
+
+capture_latency = metrics.histogram('screen_capture_duration_seconds', 'Screen captures, screencap and decoding.')
+encode_latency = metrics.histogram('screen_encode_duration_seconds', 'Screen image scaling and encoding, by format.', ['format'])
+
+
+def device_lock(serial):
+    with _thumbnails_lock:
+        if serial not in _device_locks:
+            _device_locks[serial] = threading.Lock()
+        return _device_locks[serial]
+
+
+def decode(data):
+    '''decode raw `screencap` output: a 12 byte (16 byte since android 9) header followed by the pixels.'''
+    if len(data) < 12:
+        raise ValueError('Invalid screencap output!')
+    width, height, format = struct.unpack_from('<III', data)
+    if format not in pixel_formats:
+        raise ValueError('Unsupported pixel format %d!' % format)
+    mode, rawmode, bpp = pixel_formats[format]
+    header = len(data) - width * height * bpp
+    if header not in (12, 16):
+        raise ValueError('Truncated screencap output!')
+    return Image.frombytes(mode, (width, height), data[header:], 'raw', rawmode)
+
+
+def capture(serial):
+    stream = _streams.get(serial)
+    frame = stream.frame if stream else None
+    if frame and time.time() - frame['time'] <= max_age:  # a live stream keeps the screen fresh anyway.
+        return frame['image'].copy()
+    if share is None:
+        with metrics.timer(capture_latency):
+            return decode(adb.exec_out(serial, 'screencap'))
+    shared = share.frame(serial)
+    if not _fresh(shared):
+        with share.lock(serial):  # the other workers wait for this capture, and get it.
+            shared = share.frame(serial)
+            if not _fresh(shared):
+                with metrics.timer(capture_latency):
+                    data = adb.exec_out(serial, 'screencap')
+                shared = (time.time(), time.time(), data)
+                share.put_frame(serial, shared[0], data)
+    return decode(shared[2])
+
+
+def thumbnail(serial, size, format='png'):
+    '''the current screen scaled down to fit size, encoded as format; returns (data, content_type).'''
+    key = (serial, size)
+    entry = _cached(key)
+    if entry is None:
+        with device_lock(serial):  # concurrent requests for the same device share one capture.
+            entry = _cached(key)
+            if entry is None:
+                im = capture(serial)
+                im.thumbnail(size, Image.ANTIALIAS)
+                entry = {'time': time.time(), 'image': im, 'encoded': {}}
+                with _thumbnails_lock:
+                    _thumbnails[key] = entry
+                    while len(_thumbnails) > cache_size:
+                        _thumbnails.popitem(last=False)
+    return encode(entry, format)
+
+
+def encode(entry, format):
+    name, content_type = formats[format]
+    if name not in entry['encoded']:
+        with metrics.timer(encode_latency, (name,)):
+            im = entry['image']
+            if name == 'JPEG' and im.mode != 'RGB':
+                im = im.convert('RGB')
+            out = BytesIO()
+            im.save(out, name)
+            entry['encoded'][name] = out.getvalue()
+    return entry['encoded'][name], content_type
+
+
+class ScreenStream(threading.Thread):
+    '''one capture loop per device, shared by every viewer of its screen stream.
+
+    The loop runs at the highest fps any viewer asked for and only publishes a new
+    frame when the framebuffer actually changed; each scaled size is encoded once
+    per frame whatever the number of viewers.
+
+    With several workers (see `share`), the loop of one of them captures the screen; the
+    loops of the others follow the frames it shares, and ask it for the fps they need.'''
+
+    idle_timeout = 10  # seconds the loop survives without viewers
+    max_errors = 3
+
+    def __init__(self, serial):
+        threading.Thread.__init__(self, name='screen-stream-%s' % serial)
+        self.daemon = True
+        self.serial = serial
+        self.condition = threading.Condition()
+        self.encode_lock = threading.Lock()
+        self.viewers = {}  # viewer id -> requested fps
+        self.frame = None
+        self.seq = 0
+        self.stopped = False
+        self._checksum = None
+        self._wanted_at = 0
+
+    def join_viewer(self, viewer, fps):
+        with self.condition:
+            if self.stopped:
+                return False
+            self.viewers[viewer] = fps
+            return True
+
+    def leave_viewer(self, viewer):
+        with self.condition:
+            self.viewers.pop(viewer, None)
+
+    def run(self):
+        idle_since, errors, fps = None, 0, 1
+        while errors < self.max_errors:
+            started = time.time()
+            try:
+                leading = share is None or share.lead(self.serial)
+                fps = self.wanted(leading)
+                if fps:
+                    idle_since = None
+                elif idle_since is None:
+                    idle_since = started
+                elif started - idle_since > self.idle_timeout:
+                    break
+                if leading:
+                    self.capture()
+                else:
+                    self.follow()
+                errors = 0
+            except Exception:
+                errors += 1
+            time.sleep(max(0, 1. / (fps or 1) - (time.time() - started)))
+        with _thumbnails_lock:
+            if _streams.get(self.serial) is self:
+                del _streams[self.serial]
+        if share is not None:
+            share.leave(self.serial)
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def wanted(self, leading):
+        '''the highest fps the viewers asked for, 0 without viewers.'''
+        with self.condition:
+            fps = max(self.viewers.values()) if self.viewers else 0
+        if share is None:
+            return fps
+        if leading:
+            return max(fps, share.wanted(self.serial))
+        if fps and time.time() - self._wanted_at >= 1:
+            share.want(self.serial, fps)
+            self._wanted_at = time.time()
+        return fps
+
+    def capture(self):
+        with metrics.timer(capture_latency):
+            with device_lock(self.serial):
+                data = adb.exec_out(self.serial, 'screencap')
+            checksum = zlib.crc32(data)
+            image = decode(data) if checksum != self._checksum else None
+        now = time.time()
+        if image is not None:
+            self.publish({'time': now, 'captured': now, 'image': image, 'encoded': {}}, checksum)
+            if share is not None:
+                share.put_frame(self.serial, now, data)
+        else:
+            self.frame['time'] = now
+            if share is not None:
+                share.touch_frame(self.serial)
+
+    def follow(self):
+        '''take the frame the capturing worker shared, if it is a new one.'''
+        shared = share.frame(self.serial, self.frame['captured'] if self.frame else None)
+        if not _fresh(shared):
+            return  # nothing captured lately, the capturing worker is starting
+        captured, refreshed, data = shared
+        if data is not None:
+            self.publish({'time': refreshed, 'captured': captured, 'image': decode(data), 'encoded': {}})
+        else:
+            self.frame['time'] = refreshed
+
+    def publish(self, frame, checksum=None):
+        with self.condition:
+            self._checksum, self.frame = checksum, frame
+            self.seq += 1
+            self.condition.notify_all()
+
+    def jpeg(self, frame, size):
+        with self.encode_lock:
+            if size not in frame['encoded']:
+                with metrics.timer(encode_latency, ('JPEG',)):
+                    im = frame['image'].copy()
+                    im.thumbnail(size, Image.ANTIALIAS)
+                    out = BytesIO()
+                    im.convert('RGB').save(out, 'JPEG')
+                    frame['encoded'][size] = out.getvalue()
+            return frame['encoded'][size]
+
+    def frames(self, size, fps, keepalive=5):
+        '''yield jpeg frames no faster than fps; an unchanged screen is re-sent only every keepalive seconds,
+        which is also how a gone viewer gets noticed.'''
+        seq, sent = 0, 0
+        while True:
+            with self.condition:
+                deadline = time.time() + keepalive
+                while self.seq == seq and not self.stopped and time.time() < deadline:
+                    self.condition.wait(deadline - time.time())
+                if self.stopped or self.frame is None:
+                    return
+                frame, seq = self.frame, self.seq
+            wait = 1. / fps - (time.time() - sent)
+            if wait > 0:
+                time.sleep(wait)
+            sent = time.time()
+            yield self.jpeg(frame, size)
+
+
+def stream(serial, size, fps):
+    '''multipart/x-mixed-replace body of the device screen, see ScreenStream.'''
+    viewer = object()
+    while True:
+        with _thumbnails_lock:
+            screen_stream = _streams.get(serial)
+            if screen_stream is None:
+                screen_stream = _streams[serial] = ScreenStream(serial)
+                screen_stream.start()
+        if screen_stream.join_viewer(viewer, fps):
+            break
+    try:
+        for data in screen_stream.frames(size, fps):
+            yield ('--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % (boundary, len(data))).encode('utf-8')
+            yield data + b'\r\n'
+    finally:
+        screen_stream.leave_viewer(viewer)
+
+
+def _cached(key):
+    with _thumbnails_lock:
+        entry = _thumbnails.get(key)
+        if entry is None or time.time() - entry['time'] > max_age:
+            return None
+        del _thumbnails[key]  # move to the most recently used end
+        _thumbnails[key] = entry
+        return entry
+
+
+def _fresh(shared):
+    return shared is not None and time.time() - shared[1] <= max_age
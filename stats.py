@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Background sampling of the device memory, cpu and process stats.
+
+Every attached device gets a sampler thread taking one sample per interval, with
+`cat /proc/meminfo` and `top -n 1` in a single adb shell round trip. Samples go into
+a ring of the latest `samples`, and every `downsample` of them are averaged into one
+point of a coarser ring, so a long history stays cheap to keep and to chart.
+
+When several workers share their samples (see `share`), only one of them samples the
+devices; the samplers of the others read its samples instead.
+'''
+
+import re
+import threading
+import time
+from collections import deque
+
+import adb
+
+samples = 360  # latest samples kept at full resolution
+downsample = 30  # samples averaged into one point of the coarse ring
+coarse_samples = 288  # points kept in the coarse ring
+processes = 10  # busiest processes kept per sample in the history
+marker = '--stat-sample--'
+
+share = None  # jobstore.StatShare when several workers share their samples
+
+_samplers = {}  # serial -> the running Sampler of that device
+_histories = {}  # serial -> History, kept after the device got detached
+_latest = {}  # serial -> the latest full sample
+_lock = threading.Lock()
+
+
+def parse_meminfo(out):
+    result = {}
+    for line in out.splitlines():
+        item = [i.strip() for i in line.split(':')]
+        if len(item) == 2:
+            values = item[1].split()
+            result[item[0]] = int(values[0])*1024 if len(values) == 2 and values[1] == 'kB' else int(values[0])
+    return result
+
+
+def parse_top(out):
+    result = {"processes": []}
+    m = re.search(r'User\s*(\d+)%,\s*System\s*(\d+)%,\s*IOW\s*(\d+)%,\s*IRQ\s*(\d+)%', out)
+    if m:
+        result["CPU"] = {"User": int(m.group(1))/100., "System": int(m.group(2))/100., "IOW": int(m.group(3))/100., "IRQ": int(m.group(4))/100.}
+    for item in re.findall(r'(\d+)\s+(\d+)\s+(\d+)%\s+(\w+)\s+(\d+)\s+(\d+)K\s+(\d+)K\s+(fg|bg)?\s+(\S+)\s+(\S+)', out):
+        pid, pr, cpu, s, thr, vss, rss, pcy, uid, name = item
+        result["processes"].append({"pid": int(pid), "pr": int(pr), "cpu": int(cpu)/100., "s": s, "thr": int(thr), "vss": int(vss)*1024, "rss": int(rss)*1024, "pcy": pcy, "uid": uid, "name": name})
+    return result
+
+
+def sample(serial):
+    '''{"time", "meminfo", "top"} of the device, from one adb round trip.'''
+    out = adb.shell(serial, 'cat /proc/meminfo; echo %s; top -n 1' % marker)['stdout'].decode('utf-8', 'replace')
+    meminfo, sep, top = out.partition(marker)
+    return {'time': time.time(), 'meminfo': parse_meminfo(meminfo), 'top': parse_top(top)}
+
+
+def compact(sample):
+    '''what the history keeps of a sample: memory, cpu and the busiest processes.'''
+    busiest = sorted(sample['top']['processes'], key=lambda p: -p['cpu'])[:processes]
+    return {
+        'time': sample['time'],
+        'meminfo': sample['meminfo'],
+        'cpu': sample['top'].get('CPU', {}),
+        'processes': [{'pid': p['pid'], 'name': p['name'], 'cpu': p['cpu'], 'rss': p['rss']} for p in busiest]
+    }
+
+
+def merge(points):
+    '''one point averaging the compact samples (or points) in points, timed at the first one.'''
+    n = float(len(points))
+    result = {'time': points[0]['time']}
+    for key in ('meminfo', 'cpu'):
+        names = set(name for p in points for name in p[key])
+        result[key] = dict((name, sum(p[key].get(name, 0) for p in points) / n) for name in names)
+    result['meminfo'] = dict((name, int(value)) for name, value in result['meminfo'].items())
+    by_process = {}
+    for p in points:
+        for proc in p['processes']:
+            item = by_process.setdefault((proc['pid'], proc['name']), {'pid': proc['pid'], 'name': proc['name'], 'cpu': 0., 'rss': 0})
+            item['cpu'] += proc['cpu'] / n
+            item['rss'] = max(item['rss'], proc['rss'])
+    result['processes'] = sorted(by_process.values(), key=lambda p: -p['cpu'])[:processes]
+    return result
+
+
+class History(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._fine = deque(maxlen=samples)
+        self._coarse = deque(maxlen=coarse_samples)
+        self._pending = []
+
+    def append(self, point):
+        with self._lock:
+            self._fine.append(point)
+            self._pending.append(point)
+            if len(self._pending) >= downsample:
+                self._coarse.append(merge(self._pending))
+                self._pending = []
+
+    def query(self, since=0, step=None):
+        '''the points from since on, at full resolution where still available, averaged into step seconds buckets if given.'''
+        with self._lock:
+            fine, coarse = list(self._fine), list(self._coarse)
+        if fine:
+            coarse = [p for p in coarse if p['time'] < fine[0]['time']]
+        points = [p for p in coarse + fine if p['time'] >= since]
+        if not step:
+            return points
+        buckets = []
+        for p in points:
+            bucket = int(p['time'] // step)
+            if buckets and buckets[-1][0] == bucket:
+                buckets[-1][1].append(p)
+            else:
+                buckets.append((bucket, [p]))
+        return [merge(bucket_points) for bucket, bucket_points in buckets]
+
+
+class Sampler(threading.Thread):
+
+    def __init__(self, serial, interval, history):
+        threading.Thread.__init__(self, name='stat-%s' % serial)
+        self.daemon = True
+        self.serial = serial
+        self.interval = interval
+        self.history = history
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            started = time.time()
+            if share is None or share.elect():
+                results, wait = self.sample(), self.interval
+            else:
+                results, wait = self.read(), min(self.interval, 1)
+            for result in results:
+                if self.stopped.is_set():
+                    break
+                _latest[self.serial] = result
+                self.history.append(compact(result))
+            self.stopped.wait(max(wait - (time.time() - started), 0.1))
+
+    def sample(self):
+        try:
+            result = sample(self.serial)
+        except Exception:
+            return []
+        if not result['meminfo']:
+            return []
+        if share is not None:
+            try:
+                share.put(self.serial, result, samples * self.interval)
+            except Exception:
+                pass  # the database is busy, the sample still goes into the history here
+        return [result]
+
+    def read(self):
+        try:
+            return share.read(self.serial)
+        except Exception:
+            return []
+
+
+def start(serial, interval):
+    with _lock:
+        sampler = _samplers.get(serial)
+        if sampler and sampler.is_alive() and not sampler.stopped.is_set():
+            return
+        history = _histories.setdefault(serial, History())
+        sampler = _samplers[serial] = Sampler(serial, interval, history)
+    sampler.start()
+
+
+def stop(serial):
+    with _lock:
+        sampler = _samplers.pop(serial, None)
+    _latest.pop(serial, None)
+    if sampler:
+        sampler.stopped.set()
+
+
+def latest(serial, max_age):
+    '''the latest sample of the device if not older than max_age seconds.'''
+    result = _latest.get(serial)
+    return result if result and time.time() - result['time'] <= max_age else None
+
+
+def history(serial):
+    with _lock:
+        return _histories.get(serial)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+import chunkstore
+import inotify
+
+chunk_size = 65536
+window = 1 << 20  # bytes of recent output a follower keeps in memory for its subscribers
+
+_followers = {}  # path -> the live Follower of that file
+_followers_lock = threading.Lock()
+
+
+class Follower(threading.Thread):
+    '''one follower per growing output file (plain or chunkstore), fanning the new bytes out to any number of subscribers.
+
+    The latest `window` bytes stay in memory and are shared by all subscribers; one that
+    falls further behind (a slow client, or a resume from an old offset) reads from the
+    file instead, so no subscriber can make the follower hold more than the window.'''
+
+    def __init__(self, path, alive):
+        threading.Thread.__init__(self, name='tail-%s' % path)
+        self.daemon = True
+        self.path = path
+        self.alive = alive
+        self.condition = threading.Condition()
+        self.size = 0
+        self.buffer, self.buffer_start = b'', 0
+        self.finished = False
+        self.subscribers = 0
+
+    def run(self):
+        watcher = None
+        try:
+            watcher = self._watcher()
+            reader = chunkstore.open_reader(self.path)
+            while True:
+                self._read_new(reader)
+                with _followers_lock:
+                    with self.condition:
+                        if not self.subscribers:  # checked under both locks so nobody subscribes meanwhile
+                            break
+                if not self.alive():
+                    self._read_new(reader)
+                    break
+                if watcher:
+                    watcher.read(1)  # wake on writes, and at least once a second to notice the job finished.
+                else:
+                    time.sleep(0.2)
+        finally:
+            if watcher:
+                watcher.close()
+            with _followers_lock:
+                if _followers.get(self.path) is self:
+                    del _followers[self.path]
+            with self.condition:
+                self.finished = True
+                self.condition.notify_all()
+
+    def _watcher(self):
+        '''an inotify watch of the file, None to poll it (no inotify, or out of inotify instances).'''
+        if not inotify.available():
+            return None
+        try:
+            watcher = inotify.Inotify()
+        except OSError:
+            return None
+        try:
+            watcher.add_watch(chunkstore.watch_path(self.path), inotify.IN_MODIFY | inotify.IN_CLOSE_WRITE)
+        except OSError:
+            watcher.close()
+            return None
+        return watcher
+
+    def _read_new(self, reader):
+        reader.refresh()
+        end = reader.size()
+        if end > self.size:
+            start = max(self.size, end - window)  # anything older is served from the file anyway
+            data = reader.read(start, end - start)
+            with self.condition:
+                if start > self.size:
+                    self.buffer, self.buffer_start = b'', start
+                self.buffer += data
+                self.size = start + len(data)
+                if len(self.buffer) > window:
+                    self.buffer_start += len(self.buffer) - window
+                    self.buffer = self.buffer[-window:]
+                self.condition.notify_all()
+
+    def chunk(self, offset, reader):
+        '''the bytes from offset on, waiting for them to be written; None once the file is complete.'''
+        with self.condition:
+            while offset >= self.size and not self.finished:
+                self.condition.wait(1)
+            if self.buffer_start <= offset < self.size:
+                return self.buffer[offset - self.buffer_start:offset - self.buffer_start + chunk_size]
+            size, finished = self.size, self.finished
+        if offset < size:
+            reader.refresh()
+            return reader.read(offset, chunk_size)
+        return None if finished else b''
+
+
+def follow(path, offset, alive):
+    '''yield (offset, data) chunks of path from offset on, following it for as long as alive() is true.'''
+    reader = chunkstore.open_reader(path)
+    if not alive():
+        while True:
+            data = reader.read(offset, chunk_size)
+            if not data:
+                return
+            yield offset, data
+            offset += len(data)
+    with _followers_lock:
+        follower = _followers.get(path)
+        if follower is None or follower.finished:
+            follower = _followers[path] = Follower(path, alive)
+            follower.subscribers += 1
+            follower.start()
+        else:
+            with follower.condition:
+                follower.subscribers += 1
+    try:
+        while True:
+            data = follower.chunk(offset, reader)
+            if data is None:
+                return
+            if data:
+                yield offset, data
+                offset += len(data)
+    finally:
+        with follower.condition:
+            follower.subscribers -= 1
+
+
+def offset_of_last_lines(path, lines):
+    '''byte offset where the last `lines` lines of path start.'''
+    reader = chunkstore.open_reader(path)
+    if isinstance(reader, chunkstore.ChunkReader):  # its index counts the lines, no need to read them backwards
+        size = reader.size()
+        total = (reader.newlines[-1] if reader.newlines else 0) + (1 if size and reader.read(size - 1, 1) != b'\n' else 0)
+        return reader.line_offset(total - lines)
+    pos, data = reader.size(), b''
+    while pos > 0 and data.count(b'\n', 0, len(data) - 1) < lines:
+        step = min(chunk_size, pos)
+        pos -= step
+        data = reader.read(pos, step) + data
+    index = len(data) - 1  # the newline ending the last line does not start a new one
+    for i in range(lines):
+        index = data.rfind(b'\n', 0, index)
+        if index < 0:
+            return pos
+    return pos + index + 1
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Prebuilt virtualenvs of the init scripts, keyed by what goes into them.
+
+The generated init script builds `<root>/<key>` once, under a file lock, and every job
+with the same python version and install list clones it instead of running pip again.
+The lines installing from a local path (the checkout itself, mostly) are left out of the
+cache and run in every job's copy: what they install points at the job's own workspace.
+Once a job got its copy, `python venvs.py evict --root <root> --budget <bytes>` drops the
+least recently used environments until the cache fits in the budget.
+'''
+
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+
+import paths
+
+
+def cache_key(python, installs, repo_dir):
+    '''hash of the python version, the install lines and the requirement files they refer to.'''
+    h = hashlib.sha1(json.dumps([python, installs]).encode('utf-8'))
+    for install in installs:
+        for requirements in re.findall(r'(?:-r|--requirement)[ =]+(\S+)', install):
+            try:
+                with open(os.path.join(repo_dir, requirements), 'rb') as f:
+                    h.update(f.read())
+            except (IOError, OSError):
+                pass
+    return h.hexdigest()
+
+
+def local_install(install):
+    '''whether the install line installs from a local path (pip install -e ., setup.py install...).'''
+    if 'setup.py' in install:
+        return True
+    words = install.split()
+    for i, word in enumerate(words):
+        previous = words[i - 1] if i else ''
+        if previous in ('-r', '--requirement', '-c', '--constraint') or word.startswith(('-r', '--requirement=', '-c', '--constraint=')):
+            continue
+        if previous in ('-e', '--editable') and '://' not in word or word.startswith(('.', '/', '~', 'file:')):
+            return True
+    return False
+
+
+def environments(root):
+    '''[(last used, size, path)] of the ready environments, least recently used first.'''
+    result = []
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        ready = os.path.join(path, '.ready')
+        if not os.path.isfile(ready):
+            continue
+        size_file = os.path.join(path, '.size')
+        try:
+            with open(size_file) as f:
+                size = int(f.read())
+        except (IOError, OSError, ValueError):
+            size = paths.disk_usage(path)
+            with open(size_file, 'w') as f:
+                f.write(str(size))
+        result.append((os.stat(ready).st_mtime, size, path))
+    return sorted(result)
+
+
+def evict(root, budget):
+    envs = environments(root)
+    total = sum(size for used, size, path in envs)
+    for used, size, path in envs:
+        if total <= budget:
+            break
+        with open(path + '.lock', 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                continue  # a job is building or copying it right now
+            try:
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='cache of the init script virtualenvs')
+    parser.add_argument('action', choices=['evict'])
+    parser.add_argument('--root', required=True)
+    parser.add_argument('--budget', type=int, required=True, help='bytes')
+    args = parser.parse_args()
+    if os.path.isdir(args.root):
+        evict(args.root, args.budget)
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,46 @@
 #!/bin/bash
 
 %python = init.get('python', '2.7')
+%if venv:
+venv_cache={{venv['path']}}
+mkdir -p {{venv['root']}}
+(
+  flock 9
+  if [ ! -f $venv_cache/.ready ]; then
+    rm -rf $venv_cache
+    virtualenv --system-site-packages -p /usr/bin/python{{python}} $venv_cache
+    if [ "$?" -ne "0" ]; then
+      echo "Error during creating virtual environment!"
+      exit 1
+    fi
+    source $venv_cache/bin/activate
+%for install in venv['installs']:
+    {{!install}}
+    if [ "$?" -ne "0" ]; then
+      echo "Error during installing packages!"
+      exit 1
+    fi
+%end
+    deactivate
+  fi
+  touch $venv_cache/.ready
+  cp -a --reflink=auto $venv_cache .venv
+) 9>$venv_cache.lock
+if [ "$?" -ne "0" ]; then
+  rm -rf .venv
+  exit 1
+fi
+grep -lI "$venv_cache" .venv/bin/* | xargs -r sed -i "s#$venv_cache#$PWD/.venv#g"
+source .venv/bin/activate
+{{venv['evict']}} &
+%for install in venv['local_installs']:
+{{!install}}
+if [ "$?" -ne "0" ]; then
+  echo "Error during installing packages!"
+  exit 1
+fi
+%end
+%else:
 virtualenv --system-site-packages -p /usr/bin/python{{python}} .venv
 if [ "$?" -ne "0" ]; then
   echo "Error during creating virtual environment!"
@@ -15,6 +55,7 @@ if [ "$?" -ne "0" ]; then
   exit 1
 fi
 %end
+%end
 
 frc=0
 %for before_script in init.get('before_script', {}):
@@ -1,12 +1,22 @@
 #!/bin/bash
 
+%if mirror:
+mirror=$({{mirror}} {{repo['url']}})
+%else:
+mirror=
+%end
+
 %if 'branch' in repo:
-git clone -b {{repo['branch']}} {{repo['url']}} {{local_repo}}
+git clone ${mirror:+--reference "$mirror"} -b {{repo['branch']}} {{repo['url']}} {{local_repo}}
 %else:
-git clone {{repo['url']}} {{local_repo}}
+git clone ${mirror:+--reference "$mirror"} {{repo['url']}} {{local_repo}}
 %end
 
 rc=$?
+%if mirror:
+# detached from the job's output, which must not wait for the maintenance
+({{mirror_maintenance}} </dev/null >/dev/null 2>&1 &)
+%end
 if [[ $rc != 0 ]] ; then
     echo "Error during download repo!"
     exit $rc